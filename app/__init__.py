@@ -15,6 +15,8 @@ from flask.ext.breadcrumbs import Breadcrumbs
 from flask.json import JSONEncoder
 
 from config import config, Config
+from .cache import LRUCache, ResponseCache
+from .activity import LastSeenTracker
 
 
 class CustomJSONEncoder(JSONEncoder):
@@ -40,6 +42,12 @@ breadcrumbs = Breadcrumbs()
 moment = Moment()
 mail = Mail()
 bot = telebot.TeleBot(Config.BOT_TOKEN)
+ics_cache = LRUCache(Config.ICS_CACHE_SIZE)
+ics_fragment_cache = LRUCache(Config.ICS_FRAGMENT_CACHE_SIZE)
+response_cache = ResponseCache()
+count_cache = LRUCache(Config.COUNT_CACHE_SIZE, Config.COUNT_CACHE_TTL)
+stats_cache = LRUCache(Config.STATS_CACHE_SIZE, Config.STATS_CACHE_TTL)
+last_seen_tracker = LastSeenTracker()
 
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
@@ -61,6 +69,8 @@ def create_app(config_name):
     mail.init_app(app)
     breadcrumbs.init_app(app)
     moment.init_app(app)
+    response_cache.init_app(app)
+    last_seen_tracker.init_app(app)
     login_manager.init_app(app)
 
     if not app.debug and not app.config['SSL_DISABLE']:
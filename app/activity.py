@@ -0,0 +1,57 @@
+"""
+Throttled tracking of the users' last activity.
+"""
+import threading
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+
+
+class LastSeenTracker(object):
+    """Record when users were last seen without writing on every request.
+
+    A user is marked as seen only when the stored time is older than
+    LAST_SEEN_INTERVAL seconds. Marks are kept in memory and written
+    with a single UPDATE every LAST_SEEN_FLUSH_INTERVAL seconds, so the
+    ones pending when a process exits are lost.
+
+    """
+    def __init__(self, app=None):
+        self.interval = None
+        self.flush_interval = None
+        self.pending = {}
+        self.flushed = datetime.utcnow()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = timedelta(seconds=app.config['LAST_SEEN_INTERVAL'])
+        self.flush_interval = timedelta(seconds=app.config['LAST_SEEN_FLUSH_INTERVAL'])
+
+    def ping(self, user):
+        """Mark `user` as seen now, flushing the pending marks when the
+        last flush is old enough.
+
+        """
+        now = datetime.utcnow()
+        with self.lock:
+            seen = self.pending.get(user.id) or user.last_seen
+            if seen is None or now - seen >= self.interval:
+                self.pending[user.id] = now
+            if not self.pending or now - self.flushed < self.flush_interval:
+                return
+            pending, self.pending, self.flushed = self.pending, {}, now
+        self.write(pending)
+
+    def write(self, pending):
+        from .models import db, User
+
+        table = User.__table__
+        db.session.execute(table.update()
+                           .where(table.c.id == bindparam('b_id'))
+                           .values(last_seen=bindparam('b_last_seen')),
+                           [{'b_id': user_id, 'b_last_seen': seen}
+                            for user_id, seen in pending.iteritems()])
+        db.session.commit()
@@ -1,10 +1,26 @@
 from flask import jsonify, request, current_app, url_for
-from ..models import Calendar
+from ..models import Calendar, Course, Lesson
+from ..pagination import paginate_after
+from ..serializers import courses_json
 from . import api
+from .errors import bad_request
 
 
 @api.route('/calendars/')
 def get_calendars():
+    if 'after' in request.args:
+        try:
+            pagination = paginate_after(Calendar.query, [Calendar.id])
+        except ValueError:
+            return bad_request('Invalid cursor')
+        next = None
+        if pagination.has_next:
+            next = url_for('api.get_calendars', after=pagination.next_cursor, _external=True)
+        return jsonify({
+            'calendars': [cal.to_json() for cal in pagination.items],
+            'next': next,
+            'count': pagination.total
+        })
     page = request.args.get('page', 1, type=int)
     pagination = Calendar.query.paginate(
         page, per_page=current_app.config['OBJECTS_PER_PAGE'],
@@ -34,16 +50,37 @@ def get_comment(id):
 def get_calendar_lessons(id):
     cal = Calendar.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
-    pagination = cal.lessons.paginate(
+    window = {}
+    query = cal.lessons.order_by(Lesson.start, Lesson.id)
+    if 'start' in request.args and 'end' in request.args:
+        window = {'start': request.args['start'], 'end': request.args['end']}
+        query = cal.lessons_between(window['start'], window['end'])
+    if 'after' in request.args:
+        try:
+            pagination = paginate_after(query, [Lesson.start, Lesson.id])
+        except ValueError:
+            return bad_request('Invalid cursor')
+        next = None
+        if pagination.has_next:
+            next = url_for('api.get_calendar_lessons', id=id, after=pagination.next_cursor,
+                           _external=True, **window)
+        return jsonify({
+            'lessons': [l.to_json() for l in pagination.items],
+            'next': next,
+            'count': pagination.total
+        })
+    pagination = query.paginate(
         page, per_page=current_app.config['OBJECTS_PER_PAGE'],
         error_out=False)
     lessons = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_calendar_lessons', page=page - 1, _external=True)
+        prev = url_for('api.get_calendar_lessons', id=id, page=page - 1,
+                       _external=True, **window)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_calendar_lessons', page=page + 1, _external=True)
+        next = url_for('api.get_calendar_lessons', id=id, page=page + 1,
+                       _external=True, **window)
     return jsonify({
         'lessons': [l.to_json() for l in lessons],
         'prev': prev,
@@ -56,18 +93,18 @@ def get_calendar_lessons(id):
 def get_calendar_courses(id):
     cal = Calendar.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
-    pagination = cal.courses.paginate(
+    pagination = courses_json.project(cal.courses).order_by(Course.id).paginate(
         page, per_page=current_app.config['OBJECTS_PER_PAGE'],
         error_out=False)
-    lessons = pagination.items
+    courses = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_calendar_courses', page=page - 1, _external=True)
+        prev = url_for('api.get_calendar_courses', id=id, page=page - 1, _external=True)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_calendar_courses', page=page + 1, _external=True)
+        next = url_for('api.get_calendar_courses', id=id, page=page + 1, _external=True)
     return jsonify({
-        'courses': [l.to_json() for l in lessons],
+        'courses': courses_json.dump(courses),
         'prev': prev,
         'next': next,
         'count': pagination.total
@@ -1,10 +1,12 @@
 from flask import jsonify
 from ..models import Classroom
+from ..serializers import classrooms_json
+from .. import response_cache
 from . import api
 
 
 @api.route('/classrooms/')
+@response_cache.cached('catalogue')
 def get_classrooms():
-    classrooms = Classroom.query.all()
-    return jsonify({'classrooms': [c.to_json() for c in classrooms]})
+    return jsonify({'classrooms': classrooms_json(Classroom.query)})
 
@@ -1,12 +1,30 @@
 from flask import jsonify, request, current_app, url_for
-from ..models import Course
+from flask.ext.sqlalchemy import Pagination
+from ..models import Course, User
+from ..pagination import paginate_after
+from ..serializers import courses_json
 from . import api
+from .errors import bad_request
 
 
 @api.route('/courses/')
 def get_courses():
+    if 'after' in request.args:
+        try:
+            pagination = paginate_after(courses_json.project(Course.query), [Course.id],
+                                        descending=True)
+        except ValueError:
+            return bad_request('Invalid cursor')
+        next = None
+        if pagination.has_next:
+            next = url_for('api.get_courses', after=pagination.next_cursor, _external=True)
+        return jsonify({
+            'courses': courses_json.dump(pagination.items),
+            'next': next,
+            'count': pagination.total
+        })
     page = request.args.get('page', 1, type=int)
-    pagination = Course.query.order_by(Course.id.desc()).paginate(
+    pagination = courses_json.project(Course.query).order_by(Course.id.desc()).paginate(
         page, per_page=current_app.config['OBJECTS_PER_PAGE'],
         error_out=False)
     courses = pagination.items
@@ -17,7 +35,7 @@ def get_courses():
     if pagination.has_next:
         next = url_for('api.get_courses', page=page + 1, _external=True)
     return jsonify({
-        'courses': [c.to_json() for c in courses],
+        'courses': courses_json.dump(courses),
         'prev': prev,
         'next': next,
         'count': pagination.total
@@ -34,16 +52,16 @@ def get_course(id):
 def get_course_users(id):
     course = Course.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
-    pagination = course.users.paginate(
-        page, per_page=current_app.config['OBJECTS_PER_PAGE'],
-        error_out=False)
-    users = pagination.items
+    per_page = current_app.config['OBJECTS_PER_PAGE']
+    query = course.users.order_by(User.id)
+    users = query.limit(per_page).offset((page - 1) * per_page).all() if page > 0 else []
+    pagination = Pagination(query, page, per_page, course.count_users(), users)
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_course_users', page=page - 1, _external=True)
+        prev = url_for('api.get_course_users', id=id, page=page - 1, _external=True)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_course_users', page=page + 1, _external=True)
+        next = url_for('api.get_course_users', id=id, page=page + 1, _external=True)
     return jsonify({
         'users': [u.to_json() for u in users],
         'prev': prev,
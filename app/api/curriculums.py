@@ -2,13 +2,15 @@ from sqlalchemy import or_
 
 from flask import jsonify, request
 from . import api
+from .. import response_cache
 from ..models import Curriculum, Course
+from ..serializers import courses_json, curriculums_json
 
 
 @api.route('/curriculums/')
+@response_cache.cached('catalogue')
 def get_curriculums():
-    curriculums = Curriculum.query.all()
-    return jsonify({'curriculums': [c.to_json() for c in curriculums]})
+    return jsonify({'curriculums': curriculums_json(Curriculum.query)})
 
 
 @api.route('/curriculums/<int:id>/table/courses/')
@@ -20,7 +22,7 @@ def get_curriculum_courses(id):
     descending = request.args.get('order', 'asc', type=str) == 'desc'
     search = request.args.get('search', '', type=str)
     column = sort if sort in Course.__sortable__ else 'id'
-    query = c.courses
+    query = courses_json.project(c.courses)
 
     if search:
         query = query.filter(or_(
@@ -33,6 +35,6 @@ def get_curriculum_courses(id):
         query = query.order_by(column + ' asc')
 
     return jsonify({'total': query.count(),
-                    'rows': [c.to_json() for c in query[offset:limit + offset]]})
+                    'rows': courses_json.dump(query[offset:limit + offset])})
 
 
@@ -1,10 +1,13 @@
 from flask import jsonify, request
 
 from . import api
-from ..models import db, Degree
+from .. import response_cache
+from ..models import db, Degree, Curriculum
+from ..serializers import curriculums_json
 
 
 @api.route('/degrees/')
+@response_cache.cached('catalogue')
 def get_degrees():
     cat = request.args.get('cat', '')
     degrees = Degree.query.filter_by(category_code=cat) \
@@ -13,6 +16,7 @@ def get_degrees():
 
 
 @api.route('/degrees/categories')
+@response_cache.cached('catalogue')
 def get_categories():
     degrees = db.session.query(Degree.category_code, Degree.category_desc).distinct()
     return jsonify({'categories': [{'id': d.category_code,
@@ -21,6 +25,8 @@ def get_categories():
 
 
 @api.route('/degrees/<int:id>/curriculums/')
+@response_cache.cached('catalogue')
 def get_degree_curriculums(id):
     d = Degree.query.get_or_404(id)
-    return jsonify({'curriculums': [c.to_json() for c in d.curriculums]})
+    return jsonify({'curriculums': curriculums_json(
+        Curriculum.query.filter(Curriculum.degree_id == d.id))})
@@ -1,15 +1,20 @@
 from flask import jsonify
-from ..models import Location
+from ..models import Location, Classroom
+from ..serializers import classrooms_json
+from .. import response_cache
 from . import api
 
 
 @api.route('/locations/')
+@response_cache.cached('catalogue')
 def get_locations():
     locations = Location.query.all()
     return jsonify({'locations': [l.to_json() for l in locations]})
 
 
 @api.route('/locations/<int:id>/classrooms')
+@response_cache.cached('catalogue')
 def get_locations_courses(id):
     location = Location.query.get_or_404(id)
-    return jsonify({'classrooms': [c.to_json() for c in location.classrooms]})
\ No newline at end of file
+    return jsonify({'classrooms': classrooms_json(
+        Classroom.query.filter(Classroom.location_id == location.id))})
\ No newline at end of file
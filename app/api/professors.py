@@ -1,10 +1,13 @@
 from flask import jsonify
 
-from ..models import Professor
+from ..models import Professor, Course
+from ..serializers import courses_json
+from .. import response_cache
 from . import api
 
 
 @api.route('/professors/')
+@response_cache.cached('catalogue')
 def get_professors():
     profs = Professor.query.all()
     return jsonify({'professors': [p.to_json() for p in profs]})
@@ -19,4 +22,5 @@ def get_professor_feeds(id):
 @api.route('/professors/<int:id>/courses/')
 def get_professor_courses(id):
     p = Professor.query.get_or_404(id)
-    return jsonify({'courses': [c.to_json() for c in p.courses]})
+    return jsonify({'courses': courses_json(
+        Course.query.filter(Course.professor_id == p.id).order_by(Course.id))})
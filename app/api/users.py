@@ -5,7 +5,8 @@ from sqlalchemy import or_
 from flask.ext.login import current_user
 from flask import jsonify, request
 
-from ..models import User, Course
+from ..models import User, Course, Classroom, Location
+from ..serializers import courses_json, classrooms_json
 from . import api
 from .errors import forbidden
 
@@ -30,7 +31,7 @@ def get_user_courses(id):
     descending = request.args.get('order', 'asc', type=str) == 'desc'
     search = request.args.get('search', '', type=str)
     column = sort if sort in Course.__sortable__ else 'id'
-    query = u.courses
+    query = courses_json.project(u.courses)
 
     if search:
         query = query.filter(or_(
@@ -43,7 +44,7 @@ def get_user_courses(id):
         query = query.order_by(column + ' asc')
 
     return jsonify({'total': query.count(),
-                    'rows': [c.to_json() for c in query[offset:limit + offset]]})
+                    'rows': courses_json.dump(query[offset:limit + offset])})
 
 
 @api.route('/users/<int:id>/lessons/')
@@ -54,11 +55,7 @@ def get_user_lessons(id):
 
     start = request.args.get('start', '')
     end = request.args.get('end', '')
-    lessons = [l.to_json(url=c.url, title=str(c))
-               for c in u.courses
-               for l in c.calendar.lessons_between(start, end)]
-
-    return jsonify({'lessons': lessons})
+    return jsonify({'lessons': u.lessons_json(start, end)})
 
 
 @api.route('/users/<int:id>/classrooms/')
@@ -67,12 +64,8 @@ def get_user_classrooms(id):
     if current_user.id != u.id:
         return forbidden('Insufficient permissions')
 
-    classrooms = set(classroom
-                     for course in u.courses
-                     for lesson in course.calendar.lessons
-                     for classroom in lesson.classrooms)
-
-    return jsonify({'classrooms': [c.to_json() for c in classrooms]})
+    upcoming = request.args.get('upcoming', 0, type=int)
+    return jsonify({'classrooms': classrooms_json(u.classrooms_query(upcoming))})
 
 
 @api.route('/users/<int:id>/locations/')
@@ -81,15 +74,16 @@ def get_user_locations(id):
     if current_user.id != u.id:
         return forbidden('Insufficient permissions')
 
-    classrooms = set(classroom
-                     for course in u.courses
-                     for lesson in course.calendar.lessons
-                     for classroom in lesson.classrooms)
+    upcoming = request.args.get('upcoming', 0, type=int)
+    rows = u.classrooms_query(upcoming) \
+        .join(Location, Location.id == Classroom.location_id) \
+        .with_entities(Location, Classroom.name) \
+        .order_by(Location.id, Classroom.name)
 
     locations = []
-    for location, group in groupby(classrooms, lambda c: c.location):
+    for location, group in groupby(rows, lambda row: row[0]):
         json_loc = location.to_json()
-        json_loc['classrooms'] = ', '.join(c.name for c in group)
+        json_loc['classrooms'] = ', '.join(name for l, name in group)
         locations.append(json_loc)
 
     return jsonify({'locations': locations})
@@ -13,7 +13,8 @@ from ..models import db, User
 @auth.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.ping()
+        if request.endpoint != 'static' and request.blueprint != 'api':
+            current_user.ping()
         if not current_user.confirmed \
                 and request.endpoint[:5] != 'auth.' \
                 and request.endpoint != 'static':
@@ -0,0 +1,140 @@
+"""
+In-process and shared caches of rendered responses.
+"""
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+
+from functools import wraps
+from collections import OrderedDict
+
+from flask import request, current_app
+from werkzeug.http import is_resource_modified
+
+
+class LRUCache(object):
+    """A thread safe mapping holding at most `size` items, evicting the
+    least recently used ones and, when `ttl` is given, the ones older
+    than `ttl` seconds.
+
+    """
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            expires, value = self.items.pop(key)
+            if expires is not None and expires < time.time():
+                return default
+            self.items[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl if self.ttl else None, value)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class FileCache(object):
+    """A cache stored in a local directory, shared by all the processes
+    of the host, whose items expire after `ttl` seconds. Keys must be
+    strings.
+
+    """
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key, default=None):
+        filename = self.filename(key)
+        try:
+            if self.ttl and os.path.getmtime(filename) + self.ttl < time.time():
+                return default
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return default
+
+    def set(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.filename(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+
+class ResponseCache(object):
+    """Cache the responses of read-only views, keyed by endpoint and
+    arguments and validated by a data version.
+
+    Responses are kept in process (RESPONSE_CACHE_SIZE entries) or, when
+    RESPONSE_CACHE_DIR is set, in a directory shared by the processes of
+    the host. Entries expire after RESPONSE_CACHE_TTL seconds.
+
+    """
+    def __init__(self, app=None):
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        ttl = app.config['RESPONSE_CACHE_TTL']
+        if app.config['RESPONSE_CACHE_DIR']:
+            self.store = FileCache(app.config['RESPONSE_CACHE_DIR'], ttl)
+        else:
+            self.store = LRUCache(app.config['RESPONSE_CACHE_SIZE'], ttl)
+
+    def cached(self, version):
+        """Decorate a view caching its responses until the data version
+        named `version` is bumped. Responses carry an ETag and a
+        Cache-Control header, and matching conditional requests get a
+        304 without calling the view.
+
+        """
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                from .models import DataVersion
+
+                key = repr((request.endpoint,
+                            sorted(request.view_args.iteritems()),
+                            sorted(request.args.iteritems(multi=True)),
+                            version, DataVersion.get(version)))
+                etag = hashlib.sha1(key).hexdigest()
+                if not is_resource_modified(request.environ, etag):
+                    response = current_app.response_class(status=304)
+                else:
+                    cached = self.store.get(etag)
+                    if cached is None:
+                        response = current_app.make_response(f(*args, **kwargs))
+                        if response.status_code != 200:
+                            return response
+                        self.store.set(etag, (response.get_data(), response.mimetype))
+                    else:
+                        data, mimetype = cached
+                        response = current_app.response_class(data, mimetype=mimetype)
+                response.set_etag(etag)
+                response.cache_control.public = True
+                response.cache_control.max_age = current_app.config['RESPONSE_CACHE_MAX_AGE']
+                return response
+            return decorated_function
+        return decorator
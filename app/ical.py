@@ -0,0 +1,143 @@
+"""
+iCalendar rendering of the users' timetables.
+"""
+from collections import OrderedDict
+from datetime import datetime
+
+from . import db, ics_fragment_cache
+from .models import COURSE_URL, Calendar, Classroom, Course, Lesson, Location, \
+    follows, held_at
+
+
+PRODID = '-//UniveCalendar//UniveCalendar//IT'
+DATE_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def escape(text):
+    """Escape a TEXT property value."""
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;') \
+        .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def content_line(name, value):
+    """Return the content line of a property, folded in lines of at most
+    75 octets without splitting multi-byte characters.
+
+    """
+    line = (u'%s:%s' % (name, value)).encode('utf-8')
+    if len(line) <= 75:
+        return line + '\r\n'
+    folded, size = [], 0
+    for char in line.decode('utf-8'):
+        octets = char.encode('utf-8')
+        if size + len(octets) > 75:
+            folded.append('\r\n ')
+            size = 1
+        folded.append(octets)
+        size += len(octets)
+    return ''.join(folded) + '\r\n'
+
+
+def render_event(row, stamp):
+    """Return the VEVENT of a user_timetable row. Lessons have no time
+    zone, so their times are written as floating local times.
+
+    """
+    return ''.join([
+        'BEGIN:VEVENT\r\n',
+        content_line('UID', 'lesson-%s-%s@univecalendar' % (row['lesson_id'],
+                                                            row['course_id'])),
+        content_line('DTSTAMP', stamp),
+        content_line('DTSTART', row['start'].strftime(DATE_FORMAT)),
+        content_line('DTEND', row['end'].strftime(DATE_FORMAT)),
+        content_line('SUMMARY', escape(row['title'])),
+        content_line('DESCRIPTION', escape(row['description'])),
+        content_line('LOCATION', escape(row['classrooms'])),
+        content_line('URL', COURSE_URL % row['course_id']),
+        'END:VEVENT\r\n'])
+
+
+def iter_calendar(events):
+    """Yield the VCALENDAR wrapping the VEVENT chunks of `events`."""
+    yield ''.join(['BEGIN:VCALENDAR\r\n',
+                   content_line('VERSION', '2.0'),
+                   content_line('PRODID', PRODID)])
+    for event in events:
+        yield event
+    yield 'END:VCALENDAR\r\n'
+
+
+def timetable_events(rows):
+    """Yield the VEVENTs of the user_timetable `rows`."""
+    stamp = datetime.utcnow().strftime(DATE_FORMAT) + 'Z'
+    for row in rows:
+        yield render_event(row, stamp)
+
+
+def render_fragments(courses):
+    """Render the VEVENTs of all the lessons of `courses`, given as
+    (id, name, code, calendar_id) tuples, reading the lessons of their
+    calendars with a single query. Returns a dict mapping each course
+    id to its fragment.
+
+    """
+    stamp = datetime.utcnow().strftime(DATE_FORMAT) + 'Z'
+    calendar_ids = set(course[3] for course in courses)
+    rows = db.session.query(
+        Lesson.id, Lesson.calendar_id, Lesson.start, Lesson.end,
+        Lesson.description, Classroom.name, Location.address) \
+        .outerjoin(held_at, held_at.c.lesson_id == Lesson.id) \
+        .outerjoin(Classroom, Classroom.id == held_at.c.classroom_id) \
+        .outerjoin(Location, Location.id == Classroom.location_id) \
+        .filter(Lesson.calendar_id.in_(calendar_ids)) \
+        .order_by(Lesson.calendar_id, Lesson.start, Lesson.id)
+    lessons = OrderedDict()
+    for lesson_id, calendar_id, start, end, description, classroom, address in rows:
+        lesson = lessons.get(lesson_id)
+        if lesson is None:
+            lesson = lessons[lesson_id] = {'lesson_id': lesson_id,
+                                           'calendar_id': calendar_id,
+                                           'start': start,
+                                           'end': end,
+                                           'description': description,
+                                           'classrooms': []}
+        if classroom is not None:
+            lesson['classrooms'].append(classroom + ' ' + address if address else classroom)
+    by_calendar = {}
+    for lesson in lessons.itervalues():
+        lesson['classrooms'] = ', '.join(lesson['classrooms'])
+        by_calendar.setdefault(lesson['calendar_id'], []).append(lesson)
+
+    fragments = {}
+    for course_id, name, code, calendar_id in courses:
+        title = '%s [%s]' % (name, code.upper())
+        fragments[course_id] = ''.join(
+            render_event(dict(lesson, course_id=course_id, title=title), stamp)
+            for lesson in by_calendar.get(calendar_id, []))
+    return fragments
+
+
+def course_events(user):
+    """Yield the VEVENTs of the courses followed by `user`, one fragment
+    per course. Fragments are shared by all the followers of a course and
+    rendered again only when its calendar's version or its title change.
+
+    """
+    courses = db.session.query(Course.id, Course.name, Course.code,
+                               Course.calendar_id, Calendar.version) \
+        .join(follows, follows.c.course_id == Course.id) \
+        .join(Calendar, Calendar.id == Course.calendar_id) \
+        .filter(follows.c.user_id == user.id) \
+        .order_by(Course.id).all()
+    fragments, missing = {}, []
+    for course in courses:
+        fragments[course.id] = ics_fragment_cache.get(tuple(course))
+        if fragments[course.id] is None:
+            missing.append(course)
+    if missing:
+        rendered = render_fragments([tuple(course)[:4] for course in missing])
+        for course in missing:
+            fragments[course.id] = rendered[course.id]
+            ics_fragment_cache.set(tuple(course), rendered[course.id])
+    for course in courses:
+        yield fragments[course.id]
@@ -1,18 +1,20 @@
-from ics import Calendar, Event
 from flask import render_template, redirect, url_for, request, \
-    flash, make_response, current_app, g
+    flash, current_app, g, abort, Response, stream_with_context
 from flask.ext.login import login_required, current_user
 from flask.ext.sqlalchemy import get_debug_queries
 from flask.ext.babel import gettext, ngettext, lazy_gettext
 from flask.ext import breadcrumbs
 from sqlalchemy import or_
+from werkzeug.http import is_resource_modified
 
 from forms import SearchFeedForm
 
 from . import main
 from ..auth import auth
-from ..models import Course, Feed, Professor
-from .. import babel
+from ..models import Feed, Professor, User
+from ..ical import iter_calendar, timetable_events, course_events
+from ..pagination import paginate_after
+from .. import babel, ics_cache
 
 
 @main.before_request
@@ -75,60 +77,108 @@ def feed(id):
 @main.route('/_mark_as_read', methods=['post'])
 @login_required
 def mark_as_read():
-    feed_ids = request.form.getlist('feed_id')
-    if feed_ids:
-        for f in Feed.query.filter(Feed.id.in_(feed_ids)):
-            current_user.read(f)
-    return redirect(url_for('main.feeds'))
+    feed_ids = request.form.getlist('feed_id', type=int)
+    current_user.read_many(feed_ids)
+    return redirect(url_for('main.show_feeds'))
 
 
 @main.route('/feeds', methods=['GET', 'POST'])
 @login_required
 def show_feeds():
     form = SearchFeedForm()
-    query = current_user.feeds_query().join(Professor)
+    unread = request.args.get('unread', 0, type=int)
+    if unread:
+        query = current_user.unread_feeds_query().join(Professor)
+    else:
+        query = current_user.feeds_query().join(Professor)
     if form.validate_on_submit():
         search = form.search.data
         query = query.filter(or_(Feed.title.like('%' + search + '%'),
                                  Professor.first_name.like('%' + search + '%'),
                                  Professor.last_name.like('%' + search + '%')))
-    page = request.args.get('page', 1, type=int)
-    pagination = query.order_by(Feed.timestamp.desc()).paginate(
-        page, per_page=current_app.config['OBJECTS_PER_PAGE'],
-        error_out=False)
+    if 'after' in request.args:
+        try:
+            pagination = paginate_after(query, [Feed.timestamp, Feed.id], descending=True)
+        except ValueError:
+            abort(400)
+    else:
+        page = request.args.get('page', 1, type=int)
+        pagination = query.order_by(Feed.timestamp.desc()).paginate(
+            page, per_page=current_app.config['OBJECTS_PER_PAGE'],
+            error_out=False)
     feeds = pagination.items
-    return render_template('feeds.html', form=form, feeds=feeds, pagination=pagination)
+    read_ids = current_user.read_feed_ids([f.id for f in feeds])
+    return render_template('feeds.html', form=form, feeds=feeds, pagination=pagination,
+                           read_ids=read_ids, unread=unread)
+
+
+def calendar_response(user):
+    """Return the user's timetable in ICS format, answering 304 when
+    the client's copy is still valid. Whole calendars are composed from
+    the shared per-course fragments, windows are read from the user's
+    timetable.
+
+    """
+    start = request.args.get('start')
+    end = request.args.get('end')
+    etag, last_modified = user.timetable_validators(start, end)
+    if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        body = ics_cache.get(etag)
+        if body is None:
+            if start or end:
+                events = timetable_events(user.timetable(start, end))
+            else:
+                events = course_events(user)
+
+            def render():
+                chunks = []
+                for chunk in iter_calendar(events):
+                    chunks.append(chunk)
+                    yield chunk
+                ics_cache.set(etag, ''.join(chunks))
+
+            body = stream_with_context(render())
+        response = Response(body, mimetype='text/calendar')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
 
 
 @main.route('/download')
 @login_required
 def download_calendar():
-    lessons = [l.to_json(url=c.url, title='%s [%s]' % (c.name, c.code))
-               for c in current_user.courses
-               for l in c.calendar.lessons]
-    calendar = Calendar()
-    for l in lessons:
-        calendar.events.append(Event(
-            name=l['title'],
-            begin=l['start'],
-            end=l['end'],
-            description=l['description']))
-    response = make_response(str(calendar))
+    response = calendar_response(current_user)
     response.headers["Content-Disposition"] = "attachment; filename=calendar.ics"
     return response
 
 
+@main.route('/calendar/<token>.ics')
+def subscribe_calendar(token):
+    user = User.load_user_from_calendar_token(token)
+    if user is None:
+        abort(404)
+    return calendar_response(user)
+
+
+@main.route('/calendar/reset', methods=['post'])
+@login_required
+def reset_calendar_token():
+    current_user.reset_calendar_token()
+    flash(gettext('Your calendar link has been reset, the old one no longer works.'), 'success')
+    return redirect(url_for('main.index'))
+
+
 @main.route('/follow', methods=['post'])
 @login_required
 def follow():
-    ids = request.form.getlist('course_id')
+    ids = request.form.getlist('course_id', type=int)
     if not ids:
         flash(gettext('No course selected'), 'warning')
         return redirect(url_for('main.courses'))
 
-    added = 0
-    for c in Course.query.filter(Course.id.in_(ids)).all():
-        added += current_user.follow(c)
+    added = current_user.follow_many(ids)
 
     if added > 0:
         flash(ngettext('%(num)s new course added',
@@ -142,14 +192,12 @@ def follow():
 @main.route('/unfollow', methods=['post'])
 @login_required
 def unfollow():
-    ids = request.form.getlist('course_id')
+    ids = request.form.getlist('course_id', type=int)
     if not ids:
         flash(gettext('No course selected'), 'warning')
         return redirect(url_for('main.courses'))
 
-    deleted = 0
-    for c in Course.query.filter(Course.id.in_(ids)).all():
-        deleted += current_user.unfollow(c)
+    deleted = current_user.unfollow_many(ids)
 
     if deleted > 0:
         flash(ngettext('%(num)s course deleted',
@@ -3,10 +3,13 @@ UniveCalendar Database models.
 """
 import hashlib
 
+from collections import OrderedDict
+
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, \
     URLSafeTimedSerializer
 
-from sqlalchemy import inspect, event, and_
+from sqlalchemy import inspect, event, and_, select, func, exists
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 from flask import request, current_app, render_template
 from flask.ext.login import UserMixin
@@ -14,24 +17,43 @@ from flask.ext.sqlalchemy import SignallingSession
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from . import db, login_manager, bot
+from . import db, login_manager, bot, stats_cache, last_seen_tracker
+
 
+COURSE_URL = 'http://www.unive.it/data/insegnamento/%s'
 
 follows = db.Table('follows', db.Model.metadata,
                    db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
-                   db.Column('course_id', db.Integer, db.ForeignKey('courses.id')))
+                   db.Column('course_id', db.Integer, db.ForeignKey('courses.id')),
+                   db.UniqueConstraint('user_id', 'course_id'),
+                   db.Index('ix_follows_course_id_user_id', 'course_id', 'user_id'))
 
 reads = db.Table('reads', db.Model.metadata,
                  db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
-                 db.Column('feed_id', db.Integer, db.ForeignKey('feeds.id')))
+                 db.Column('feed_id', db.Integer, db.ForeignKey('feeds.id')),
+                 db.UniqueConstraint('user_id', 'feed_id'))
 
 held_at = db.Table('held_at', db.Model.metadata,
                    db.Column('lesson_id', db.Integer, db.ForeignKey('lessons.id')),
-                   db.Column('classroom_id', db.Integer, db.ForeignKey('classrooms.id')))
+                   db.Column('classroom_id', db.Integer, db.ForeignKey('classrooms.id')),
+                   db.UniqueConstraint('lesson_id', 'classroom_id'))
 
 courses_curriculums = db.Table('courses_curriculums', db.Model.metadata,
                                db.Column('course_id', db.Integer, db.ForeignKey('courses.id')),
-                               db.Column('curriculum_id', db.Integer, db.ForeignKey('curriculums.id')))
+                               db.Column('curriculum_id', db.Integer, db.ForeignKey('curriculums.id')),
+                               db.UniqueConstraint('course_id', 'curriculum_id'))
+
+user_timetable = db.Table('user_timetable', db.Model.metadata,
+                          db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+                          db.Column('course_id', db.Integer, db.ForeignKey('courses.id'), primary_key=True),
+                          db.Column('lesson_id', db.Integer, db.ForeignKey('lessons.id'), primary_key=True),
+                          db.Column('start', db.DateTime(), nullable=False),
+                          db.Column('end', db.DateTime(), nullable=False),
+                          db.Column('description', db.Text),
+                          db.Column('has_changed', db.Boolean, default=False),
+                          db.Column('title', db.Text),
+                          db.Column('classrooms', db.Text),
+                          db.Index('ix_user_timetable_user_id_start', 'user_id', 'start'))
 
 
 class User(UserMixin, db.Model):
@@ -43,11 +65,14 @@ class User(UserMixin, db.Model):
     confirmed = db.Column(db.Boolean, default=False)
     member_since = db.Column(db.DateTime(), default=datetime.utcnow)
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
+    timetable_updated = db.Column(db.DateTime(), default=datetime.utcnow)
+    calendar_token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    stats_updated = db.Column(db.DateTime(), default=datetime.utcnow)
     avatar_hash = db.Column(db.String(32))
     telegram_chat_id = db.Column(db.String(64))
     courses = db.relationship('Course',
                               secondary=follows,
-                              backref='users',
+                              backref=db.backref('users', lazy='dynamic'),
                               lazy='dynamic')
     feeds = db.relationship('Feed',
                             secondary=reads,
@@ -66,15 +91,89 @@ class User(UserMixin, db.Model):
     @password.setter
     def password(self, password):
         self.password_hash = generate_password_hash(password)
+        self.calendar_token_version = (self.calendar_token_version or 0) + 1
 
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def timetable(self, start=None, end=None):
+        """Return the rows of the user's timetable overlapping the window
+        from `start` to `end`, ordered by start, with a range scan. Either
+        bound may be omitted.
+
+        """
+        t = user_timetable.c
+        query = select([user_timetable]).where(t.user_id == self.id)
+        if start:
+            query = query.where(t.end > start)
+        if end:
+            query = query.where(t.start < end)
+        return db.session.execute(query.order_by(t.start, t.course_id, t.lesson_id))
+
+    def timetable_validators(self, start=None, end=None):
+        """Return the ETag and the last modification time of the user's
+        timetable in a window. They change whenever the user follows or
+        unfollows a course or the synchronized lessons change, and are
+        computed reading only the data_versions table.
+
+        """
+        version, updated = db.session.query(DataVersion.version, DataVersion.updated) \
+            .filter(DataVersion.name == 'lessons').first() or (0, None)
+        key = (self.id, version, self.timetable_updated, start, end)
+        last_modified = max([d for d in (updated, self.timetable_updated, self.member_since)
+                             if d is not None] or [None])
+        return hashlib.sha1(repr(key)).hexdigest(), last_modified
+
+    def lessons_json(self, start, end):
+        """Return the JSON of the lessons of the followed courses between
+        `start` and `end`, read from the user's timetable. Lessons
+        straddling the bounds of the window are included.
+
+        """
+        return [timetable_json(row) for row in self.timetable(start, end)]
+
+    def classrooms_query(self, upcoming=False):
+        """Return the query of the distinct classrooms where the lessons of
+        the followed courses, or only the upcoming ones, are held.
+
+        """
+        classroom_ids = db.session.query(held_at.c.classroom_id) \
+            .join(Lesson, Lesson.id == held_at.c.lesson_id) \
+            .join(Course, Course.calendar_id == Lesson.calendar_id) \
+            .join(follows, follows.c.course_id == Course.id) \
+            .filter(follows.c.user_id == self.id)
+        if upcoming:
+            classroom_ids = classroom_ids.filter(Lesson.end > datetime.utcnow())
+        return Classroom.query.filter(Classroom.id.in_(classroom_ids.subquery()))
+
     def count_credits(self):
-        return sum([c.credit for c in self.courses])
+        return db.session.query(func.coalesce(func.sum(Course.credit), 0)) \
+            .join(follows, follows.c.course_id == Course.id) \
+            .filter(follows.c.user_id == self.id).scalar()
 
     def count_lessons(self):
-        return sum([c.calendar.lessons.count() for c in self.courses])
+        return db.session.query(func.count(Lesson.id)) \
+            .join(Course, Course.calendar_id == Lesson.calendar_id) \
+            .join(follows, follows.c.course_id == Course.id) \
+            .filter(follows.c.user_id == self.id).scalar()
+
+    def stats(self):
+        """Return the counters shown on every page: followed courses,
+        credits, lessons, feeds and unread feeds. They are cached until
+        the user follows, unfollows or reads something, or the sync changes
+        the lessons, and for at most STATS_CACHE_TTL seconds.
+
+        """
+        key = (self.id, self.stats_updated, DataVersion.get('lessons'))
+        stats = stats_cache.get(key)
+        if stats is None:
+            stats = {'courses': self.courses.count(),
+                     'credits': self.count_credits(),
+                     'lessons': self.count_lessons(),
+                     'feeds': self.count_feeds(),
+                     'unread_feeds': self.count_unread_feeds()}
+            stats_cache.set(key, stats)
+        return stats
 
     def gravatar(self, size=100, default='identicon', rating='g'):
         if request.is_secure:
@@ -87,59 +186,128 @@ class User(UserMixin, db.Model):
             url=url, hash=hash, size=size, default=default, rating=rating)
 
     def follow(self, course):
-        if not self.is_following(course):
-            self.courses.append(course)
-            db.session.commit()
-            return True
-        return False
+        return self.follow_many([course.id]) > 0
 
     def unfollow(self, course):
-        if self.is_following(course):
-            self.courses.remove(course)
+        return self.unfollow_many([course.id]) > 0
+
+    def follow_many(self, course_ids):
+        """Follow the existing courses among `course_ids` not followed yet,
+        with a single insert and commit. Returns how many were added.
+
+        """
+        if not course_ids:
+            return 0
+        followed = exists().where(and_(follows.c.user_id == self.id,
+                                       follows.c.course_id == Course.id))
+        added = [course_id for course_id, in db.session.query(Course.id)
+                 .filter(Course.id.in_(course_ids), ~followed)]
+        if added:
+            db.session.execute(follows.insert(), [{'user_id': self.id, 'course_id': course_id}
+                                                  for course_id in added])
+            self.timetable_updated = self.stats_updated = datetime.utcnow()
+            rebuild_timetable(user_ids=[self.id], course_ids=added)
             db.session.commit()
-            return True
-        return False
+        return len(added)
+
+    def unfollow_many(self, course_ids):
+        """Stop following the followed courses among `course_ids`, with a
+        single delete and commit. Returns how many were removed.
+
+        """
+        if not course_ids:
+            return 0
+        removed = [course_id for course_id, in db.session.query(follows.c.course_id)
+                   .filter(follows.c.user_id == self.id,
+                           follows.c.course_id.in_(course_ids))]
+        if removed:
+            db.session.execute(follows.delete().where(
+                and_(follows.c.user_id == self.id, follows.c.course_id.in_(removed))))
+            db.session.execute(user_timetable.delete().where(
+                and_(user_timetable.c.user_id == self.id,
+                     user_timetable.c.course_id.in_(removed))))
+            self.timetable_updated = self.stats_updated = datetime.utcnow()
+            db.session.commit()
+        return len(removed)
 
     def is_following(self, course):
-        return course in self.courses
+        return db.session.query(exists().where(
+            and_(follows.c.user_id == self.id, follows.c.course_id == course.id))).scalar()
 
     def read(self, feed):
-        if not self.has_read(feed):
-            self.feeds.append(feed)
+        return self.read_many([feed.id]) > 0
+
+    def read_many(self, feed_ids):
+        """Mark as read the existing feeds among `feed_ids` not read yet,
+        with a single insert and commit. Returns how many were marked.
+
+        """
+        if not feed_ids:
+            return 0
+        read = exists().where(and_(reads.c.user_id == self.id,
+                                   reads.c.feed_id == Feed.id))
+        added = [feed_id for feed_id, in db.session.query(Feed.id)
+                 .filter(Feed.id.in_(feed_ids), ~read)]
+        if added:
+            db.session.execute(reads.insert(), [{'user_id': self.id, 'feed_id': feed_id}
+                                                for feed_id in added])
+            self.stats_updated = datetime.utcnow()
             db.session.commit()
-            return True
-        return False
+        return len(added)
 
     def unread(self, feed):
-        if self.has_read:
-            self.feeds.remove(feed)
+        if self.has_read(feed):
+            db.session.execute(reads.delete().where(
+                and_(reads.c.user_id == self.id, reads.c.feed_id == feed.id)))
+            self.stats_updated = datetime.utcnow()
             db.session.commit()
             return True
         return False
 
     def has_read(self, feed):
-        return feed in self.feeds
+        return db.session.query(exists().where(
+            and_(reads.c.user_id == self.id, reads.c.feed_id == feed.id))).scalar()
+
+    def read_feed_ids(self, feed_ids):
+        """Return the set of the ids among `feed_ids` of the feeds read by
+        the user, with a single lookup of the reads index.
+
+        """
+        if not feed_ids:
+            return set()
+        rows = db.session.query(reads.c.feed_id) \
+            .filter(reads.c.user_id == self.id, reads.c.feed_id.in_(feed_ids))
+        return set(feed_id for feed_id, in rows)
 
     def feeds_query(self):
-        if self.courses.count() == 0:
-            return
-        professor_ids = set([c.professor_id for c in self.courses])
-        return Feed.query.filter(Feed.professor_id.in_(professor_ids))
+        """Return the query of the feeds of the followed courses'
+        professors.
+
+        """
+        professor_ids = db.session.query(Course.professor_id) \
+            .join(follows, follows.c.course_id == Course.id) \
+            .filter(follows.c.user_id == self.id)
+        return Feed.query.filter(Feed.professor_id.in_(professor_ids.subquery()))
 
     def count_feeds(self):
-        query = self.feeds_query()
-        if query is not None:
-            return query.count()
+        return self.feeds_query().with_entities(func.count(Feed.id)).scalar()
+
+    def unread_feeds_query(self):
+        """Return the query of the feeds of the followed courses'
+        professors not read by the user, as an anti-join on the reads
+        (user_id, feed_id) index.
+
+        """
+        return self.feeds_query() \
+            .outerjoin(reads, and_(reads.c.feed_id == Feed.id,
+                                   reads.c.user_id == self.id)) \
+            .filter(reads.c.feed_id == None)
 
     def count_unread_feeds(self):
-        query = self.feeds_query()
-        if query is not None:
-            return query.filter(~Feed.users.contains(self)).count()
+        return self.unread_feeds_query().with_entities(func.count(Feed.id)).scalar()
 
     def get_latest_feeds(self, n=3):
-        query = self.feeds_query()
-        if query is not None:
-            return query.order_by(Feed.timestamp.desc()).limit(n).all()
+        return self.feeds_query().order_by(Feed.timestamp.desc()).limit(n).all()
 
     def generate_reset_token(self, expiration=3600):
         s = Serializer(current_app.config['SECRET_KEY'], expiration)
@@ -209,10 +377,35 @@ class User(UserMixin, db.Model):
             return
         return User.query.get(data.get('unique_code'))
 
-    def ping(self):
-        self.last_seen = datetime.utcnow()
+    def generate_calendar_token(self):
+        s = URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='calendar')
+        return s.dumps({'calendar': self.id, 'version': self.calendar_token_version or 0})
+
+    def reset_calendar_token(self):
+        """Revoke the calendar subscription links given out so far."""
+        self.calendar_token_version = (self.calendar_token_version or 0) + 1
         db.session.commit()
 
+    @staticmethod
+    def load_user_from_calendar_token(token):
+        """Return the user of a calendar subscription token, or None if
+        the token is invalid or was revoked by a password change or a
+        reset of the link.
+
+        """
+        s = URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='calendar')
+        try:
+            data = s.loads(token)
+        except:
+            return
+        user = User.query.get(data.get('calendar'))
+        if user is None or data.get('version', 0) != (user.calendar_token_version or 0):
+            return
+        return user
+
+    def ping(self):
+        last_seen_tracker.ping(self)
+
     def to_json(self):
         json_user = {
             'id': self.id,
@@ -335,7 +528,7 @@ class Course(db.Model):
     period = db.Column(db.String(32))
     year = db.Column(db.Integer)
     partition = db.Column(db.String(32))
-    calendar_id = db.Column(db.Integer, db.ForeignKey('calendars.id'))
+    calendar_id = db.Column(db.Integer, db.ForeignKey('calendars.id'), index=True)
     professor_id = db.Column(db.Integer, db.ForeignKey('professors.id'))
 
     def __repr__(self):
@@ -343,7 +536,12 @@ class Course(db.Model):
 
     @property
     def url(self):
-        return 'http://www.unive.it/data/insegnamento/%s' % self.id
+        return COURSE_URL % self.id
+
+    def count_users(self):
+        """Count the followers reading only the follows index."""
+        return db.session.query(db.func.count(follows.c.user_id)) \
+            .filter(follows.c.course_id == self.id).scalar()
 
     def to_json(self):
         json_course = {
@@ -367,13 +565,15 @@ class Course(db.Model):
 class Calendar(db.Model):
     __tablename__ = 'calendars'
     id = db.Column(db.Integer, primary_key=True)
-    courses = db.relationship('Course', backref='calendar')
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    courses = db.relationship('Course', backref='calendar', lazy='dynamic')
     lessons = db.relationship('Lesson',
                               backref='calendar',
                               lazy='dynamic')
 
     def lessons_between(self, start, end):
-        return self.lessons.filter(and_(Lesson.start >= start, Lesson.end <= end))
+        return self.lessons.filter(Lesson.overlapping(start, end)) \
+            .order_by(Lesson.start, Lesson.id)
 
     def to_json(self):
         json_calendar = {'id': self.id}
@@ -385,17 +585,27 @@ class Lesson(db.Model):
     __table_args__ = (db.UniqueConstraint('start',
                                           'end',
                                           'calendar_id',
-                                          'description'),)
+                                          'description'),
+                      db.Index('ix_lessons_calendar_id_start', 'calendar_id', 'start'))
     id = db.Column(db.Integer, primary_key=True)
     start = db.Column(db.DateTime(), nullable=False)
     end = db.Column(db.DateTime(), nullable=False)
     description = db.Column(db.Text)
     has_changed = db.Column(db.Boolean, default=False)
-    calendar_id = db.Column(db.Integer, db.ForeignKey('calendars.id'), index=True)
+    calendar_id = db.Column(db.Integer, db.ForeignKey('calendars.id'))
     classrooms = db.relationship('Classroom',
                                  secondary=held_at,
                                  backref='lessons')
 
+    @staticmethod
+    def overlapping(start, end):
+        """Return the condition matching the lessons which overlap the
+        window from `start` to `end`, including the ones straddling its
+        bounds.
+
+        """
+        return and_(Lesson.start < end, Lesson.end > start)
+
     @property
     def duration(self):
         return self.start - self.end
@@ -427,29 +637,177 @@ def get_old_value(attr_state):
 
 
 def on_lesson_change_event(lesson):
-    insp = inspect(lesson)
-    start_state = insp.attrs.start
-    end_state = insp.attrs.end
-    old_start_value = get_old_value(start_state)
-    old_end_value = get_old_value(end_state)
-    if old_start_value or old_end_value:
-        for course in lesson.calendar.courses:
-            new_feed = Feed(title='Modifica orario',
-                            body=render_template('messages/changed_schedule_feed.txt').format(
-                                title=course.name,
-                                day=start_state.value.strftime('%d.%m.%Y'),
-                                start=start_state.value.strftime('%H:%M %d.%m.%Y'),
-                                end=end_state.value.strftime('%H:%M %d.%m.%Y')),
-                            professor=course.professor)
-            db.session.add(new_feed)
-        lesson.has_changed = True
+    """Publish a feed about the new schedule of `lesson` for each of
+    its calendar's courses which have a professor and flag the lesson as
+    changed.
+
+    """
+    with db.session.no_autoflush:
+        courses = lesson.calendar.courses.filter(Course.professor_id != None).all()
+    for course in courses:
+        new_feed = Feed(title='Modifica orario',
+                        body=render_template('messages/changed_schedule_feed.txt').format(
+                            title=course.name,
+                            day=lesson.start.strftime('%d.%m.%Y'),
+                            start=lesson.start.strftime('%H:%M %d.%m.%Y'),
+                            end=lesson.end.strftime('%H:%M %d.%m.%Y')),
+                        professor=course.professor)
+        db.session.add(new_feed)
+    lesson.has_changed = True
+    db.session.execute(user_timetable.update()
+                       .where(user_timetable.c.lesson_id == lesson.id)
+                       .values(start=lesson.start, end=lesson.end, has_changed=True))
+    calendars = Calendar.__table__
+    db.session.execute(calendars.update()
+                       .where(calendars.c.id == lesson.calendar_id)
+                       .values(version=calendars.c.version + 1))
+    DataVersion.bump('lessons')
+
+
+def rebuild_timetable(user_ids=None, course_ids=None, lesson_ids=None):
+    """Recompute the user_timetable rows of the given users, courses and
+    lessons, or the whole table when none is given. The changes are made
+    in the current session and left to the caller to commit.
+
+    """
+    t = user_timetable.c
+    delete = user_timetable.delete()
+    rows = db.session.query(
+        follows.c.user_id, Course.id, Course.name, Course.code, Lesson.id,
+        Lesson.start, Lesson.end, Lesson.description, Lesson.has_changed,
+        Classroom.name, Location.address) \
+        .select_from(follows) \
+        .join(Course, Course.id == follows.c.course_id) \
+        .join(Lesson, Lesson.calendar_id == Course.calendar_id) \
+        .outerjoin(held_at, held_at.c.lesson_id == Lesson.id) \
+        .outerjoin(Classroom, Classroom.id == held_at.c.classroom_id) \
+        .outerjoin(Location, Location.id == Classroom.location_id)
+    for column, source, ids in ((t.user_id, follows.c.user_id, user_ids),
+                                (t.course_id, Course.id, course_ids),
+                                (t.lesson_id, Lesson.id, lesson_ids)):
+        if ids is not None:
+            if not ids:
+                return
+            delete = delete.where(column.in_(ids))
+            rows = rows.filter(source.in_(ids))
+    db.session.execute(delete)
+
+    entries = OrderedDict()
+    for (user_id, course_id, course_name, course_code, lesson_id, start, end,
+         description, has_changed, classroom, address) in rows:
+        entry = entries.get((user_id, course_id, lesson_id))
+        if entry is None:
+            entry = entries[(user_id, course_id, lesson_id)] = {
+                'user_id': user_id,
+                'course_id': course_id,
+                'lesson_id': lesson_id,
+                'start': start,
+                'end': end,
+                'description': description,
+                'has_changed': has_changed,
+                'title': '%s [%s]' % (course_name, course_code.upper()),
+                'classrooms': []
+            }
+        if classroom is not None:
+            entry['classrooms'].append(
+                classroom + ' ' + address if address else classroom)
+    for entry in entries.itervalues():
+        entry['classrooms'] = ', '.join(entry['classrooms'])
+    if entries:
+        db.session.execute(user_timetable.insert(), entries.values())
+
+
+def timetable_json(row):
+    return {
+        'id': row['lesson_id'],
+        'start': row['start'].strftime('%Y-%m-%d %H:%M:00'),
+        'end': row['end'].strftime('%Y-%m-%d %H:%M:00'),
+        'past': row['end'] <= datetime.utcnow(),
+        'has_changed': row['has_changed'],
+        'description': row['description'],
+        'classrooms': row['classrooms'],
+        'url': COURSE_URL % row['course_id'],
+        'title': row['title']
+    }
+
+
+def on_lessons_cancel_event(calendar, lessons):
+    """Publish a single feed listing the cancelled `lessons`, given as
+    (start, end) pairs, for each of the calendar's courses which have a
+    professor.
+
+    """
+    dates = '\n'.join('- %s %s - %s' % (start.strftime('%d.%m.%Y'),
+                                         start.strftime('%H:%M'),
+                                         end.strftime('%H:%M'))
+                       for start, end in lessons)
+    for course in calendar.courses.filter(Course.professor_id != None):
+        new_feed = Feed(title='Lezioni annullate',
+                        body=render_template('messages/cancelled_lessons_feed.txt').format(
+                            title=course.name,
+                            lessons=dates),
+                        professor=course.professor)
+        db.session.add(new_feed)
 
 
 @event.listens_for(SignallingSession, 'before_flush')
 def receive_after_flush(session, flush_context, instances):
     for changed_obj in session.dirty:
         if type(changed_obj) is Lesson:
-            on_lesson_change_event(changed_obj)
+            insp = inspect(changed_obj)
+            old_start = get_old_value(insp.attrs.start)
+            old_end = get_old_value(insp.attrs.end)
+            if old_start or old_end:
+                on_lesson_change_event(changed_obj)
+
+
+class DataVersion(db.Model):
+    """A counter bumped whenever a group of the synchronized data changes,
+    used to validate the caches built on it.
+
+    """
+    __tablename__ = 'data_versions'
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.DateTime(), default=datetime.utcnow)
+
+    @staticmethod
+    def get(name):
+        return db.session.query(DataVersion.version) \
+            .filter(DataVersion.name == name).scalar() or 0
+
+    @staticmethod
+    def seed(*names):
+        """Create the missing rows of the versions `names`, each in its own
+        transaction, so that bumping them later is a plain UPDATE which
+        concurrent bumps cannot race on.
+
+        """
+        table = DataVersion.__table__
+        for name in names:
+            try:
+                with db.engine.begin() as conn:
+                    if conn.execute(select([table.c.name]).where(table.c.name == name)).first():
+                        continue
+                    conn.execute(table.insert().values(name=name, version=0,
+                                                       updated=datetime.utcnow()))
+            except IntegrityError:
+                pass
+
+    @staticmethod
+    def bump(name):
+        """Increment the version `name` in the current session, the caller
+        commits. The row is inserted if the version was not seeded.
+
+        """
+        table = DataVersion.__table__
+        result = db.session.execute(table.update()
+                                    .where(table.c.name == name)
+                                    .values(version=table.c.version + 1,
+                                            updated=datetime.utcnow()))
+        if not result.rowcount:
+            db.session.execute(table.insert().values(name=name, version=1,
+                                                     updated=datetime.utcnow()))
 
 
 class Classroom(db.Model):
@@ -525,8 +883,10 @@ class Feed(db.Model):
 
 def on_new_feed(mapper, connection, target):
     """Notify users with Telegram message."""
+    if target.professor is None:
+        return
     followers = [u for c in target.professor.courses
-                 for u in c.users if u.telegram_chat_id]
+                 for u in c.users.filter(User.telegram_chat_id != None)]
     for f in followers:
         bot.send_message(f.telegram_chat_id,
                          '{title}\nFrom: {professor}\n{body}'.format(
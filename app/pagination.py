@@ -0,0 +1,125 @@
+"""
+Keyset pagination of ordered queries.
+"""
+import json
+import base64
+
+from datetime import datetime
+
+from flask import request, current_app
+from sqlalchemy import DateTime, Integer, String, and_, or_
+
+from . import count_cache
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    """Return the opaque cursor of a row given the values of its
+    ordering columns.
+
+    """
+    return base64.urlsafe_b64encode(json.dumps(
+        [v.strftime(DATETIME_FORMAT) if isinstance(v, datetime) else v
+         for v in values]))
+
+
+def decode_value(value, column):
+    """Return the value of `column` encoded as `value` in a cursor,
+    raising ValueError if it is not of the type of the column.
+
+    """
+    if isinstance(column.type, DateTime):
+        if not isinstance(value, basestring):
+            raise ValueError('Invalid cursor')
+        return datetime.strptime(value, DATETIME_FORMAT)
+    if isinstance(column.type, Integer):
+        if isinstance(value, bool) or not isinstance(value, (int, long)):
+            raise ValueError('Invalid cursor')
+        return value
+    if isinstance(column.type, String):
+        if not isinstance(value, basestring):
+            raise ValueError('Invalid cursor')
+        return value
+    raise ValueError('Invalid cursor')
+
+
+def decode_cursor(cursor, columns):
+    """Return the values of the ordering `columns` encoded in `cursor`,
+    raising ValueError if it is not a valid cursor for them.
+
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor')
+    try:
+        return [decode_value(v, c) for c, v in zip(columns, values)]
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def following(columns, values, descending=False):
+    """Return the condition matching the rows which follow the one with
+    the given `values` in the order of `columns`.
+
+    """
+    conditions = []
+    for i, column in enumerate(columns):
+        bound = column < values[i] if descending else column > values[i]
+        conditions.append(and_(*[c == v for c, v in zip(columns[:i], values[:i])] + [bound]))
+    return or_(*conditions)
+
+
+def approximate_count(query):
+    """Return the number of rows of `query`, cached for COUNT_CACHE_TTL
+    seconds.
+
+    """
+    statement = query.statement.compile()
+    key = repr((str(statement), sorted(statement.params.iteritems())))
+    total = count_cache.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        count_cache.set(key, total)
+    return total
+
+
+class KeysetPagination(object):
+    """A page of `query` ordered by `columns`, made of the `per_page` rows
+    following the one identified by `cursor`, or of the first ones when
+    the cursor is empty. Unlike OFFSET pagination deep pages cost the same
+    as the first one.
+
+    """
+    def __init__(self, query, columns, cursor, per_page, descending=False,
+                 count=True):
+        self.cursor = cursor or None
+        ordered = query.order_by(None).order_by(
+            *[c.desc() if descending else c.asc() for c in columns])
+        if self.cursor:
+            ordered = ordered.filter(following(columns, decode_cursor(cursor, columns),
+                                               descending))
+        items = ordered.limit(per_page + 1).all()
+        self.items = items[:per_page]
+        self.has_prev = self.cursor is not None
+        self.has_next = len(items) > per_page
+        self.next_cursor = None
+        if self.has_next:
+            self.next_cursor = encode_cursor([getattr(self.items[-1], c.key)
+                                              for c in columns])
+        self.total = approximate_count(query) if count else None
+
+
+def paginate_after(query, columns, descending=False):
+    """Return the KeysetPagination of `query` requested by the `after`
+    cursor and the optional `count` flag of the query string.
+
+    """
+    return KeysetPagination(query, columns, request.args.get('after'),
+                            current_app.config['OBJECTS_PER_PAGE'],
+                            descending=descending,
+                            count=request.args.get('count', 1, type=int))
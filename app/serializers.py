@@ -0,0 +1,109 @@
+"""
+Lightweight serializers of the list endpoints.
+
+Each serializer declares the columns an output shape needs, including
+the ones of related tables, so that a list is read with one projected
+query instead of loading ORM objects and their relationships one by one.
+"""
+from .models import db, Course, Curriculum, Degree, Professor, Classroom, \
+    Location, COURSE_URL, courses_curriculums
+
+
+class Serializer(object):
+    """Serialize the rows of a query selecting only `fields`, a list of
+    (key, column) pairs, outer joining the `joins` tables on their
+    conditions. `extend` is called with the list of built dicts to add
+    the fields which need another query or some formatting.
+
+    """
+    def __init__(self, fields, joins=(), extend=None):
+        self.fields = fields
+        self.joins = joins
+        self.extend = extend
+
+    def project(self, query):
+        """Return `query` selecting only the serialized columns. The result
+        can still be filtered, ordered, sliced and paginated.
+
+        """
+        query = query.with_entities(*[c.label(k) for k, c in self.fields])
+        for table, onclause in self.joins:
+            query = query.outerjoin(table, onclause)
+        return query
+
+    def dump(self, rows):
+        """Build the dicts of the rows of a projected query."""
+        keys = [k for k, c in self.fields]
+        items = [dict(zip(keys, row)) for row in rows]
+        if self.extend and items:
+            self.extend(items)
+        return items
+
+    def __call__(self, query):
+        return self.dump(self.project(query))
+
+
+def extend_courses(items):
+    degrees = {}
+    rows = db.session.query(courses_curriculums.c.course_id, Degree.name) \
+        .join(Curriculum, Curriculum.id == courses_curriculums.c.curriculum_id) \
+        .join(Degree, Degree.id == Curriculum.degree_id) \
+        .filter(courses_curriculums.c.course_id.in_([i['id'] for i in items])) \
+        .distinct()
+    for course_id, name in rows:
+        degrees.setdefault(course_id, set()).add(name)
+    for item in items:
+        first_name, last_name = item.pop('professor_first_name'), item.pop('professor_last_name')
+        item['professor'] = '%s %s' % (first_name.title(), last_name.title()) \
+            if first_name is not None else 'None'
+        item['url'] = COURSE_URL % item['id']
+        item['degrees'] = ', '.join(sorted(degrees.get(item['id'], ())))
+
+
+courses_json = Serializer(
+    [('id', Course.id),
+     ('code', Course.code),
+     ('name', Course.name),
+     ('field', Course.field),
+     ('credit', Course.credit),
+     ('total_credit', Course.total_credit),
+     ('period', Course.period),
+     ('year', Course.year),
+     ('calendar', Course.calendar_id),
+     ('partition', Course.partition),
+     ('professor_first_name', Professor.first_name),
+     ('professor_last_name', Professor.last_name)],
+    joins=[(Professor, Professor.id == Course.professor_id)],
+    extend=extend_courses)
+
+
+def extend_classrooms(items):
+    for item in items:
+        if item.pop('location_id') is None:
+            for key in ('address', 'lat', 'lng', 'polyline'):
+                del item[key]
+        else:
+            item['lat'] = float(item['lat']) if item['lat'] else None
+            item['lng'] = float(item['lng']) if item['lng'] else None
+
+
+classrooms_json = Serializer(
+    [('id', Classroom.id),
+     ('code', Classroom.code),
+     ('name', Classroom.name),
+     ('capacity', Classroom.capacity),
+     ('location_id', Location.id),
+     ('address', Location.address),
+     ('lat', Location.lat),
+     ('lng', Location.lng),
+     ('polyline', Location.polyline)],
+    joins=[(Location, Location.id == Classroom.location_id)],
+    extend=extend_classrooms)
+
+
+curriculums_json = Serializer(
+    [('id', Curriculum.id),
+     ('degree', Degree.name),
+     ('code', Curriculum.code),
+     ('name', Curriculum.name)],
+    joins=[(Degree, Degree.id == Curriculum.degree_id)])
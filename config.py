@@ -13,6 +13,18 @@ class Config:
     WHOOSH_BASE = os.path.join(basedir, 'search.db')
     SLOW_DB_QUERY_TIME = 0.2
     OBJECTS_PER_PAGE = 10
+    ICS_CACHE_SIZE = 128
+    ICS_FRAGMENT_CACHE_SIZE = 1024
+    RESPONSE_CACHE_SIZE = 256
+    RESPONSE_CACHE_TTL = 24 * 3600
+    RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR')
+    RESPONSE_CACHE_MAX_AGE = 300
+    COUNT_CACHE_SIZE = 1024
+    COUNT_CACHE_TTL = 300
+    STATS_CACHE_SIZE = 1024
+    STATS_CACHE_TTL = 300
+    LAST_SEEN_INTERVAL = 300
+    LAST_SEEN_FLUSH_INTERVAL = 60
     BOT_NAME = 'UniveCalBot'
     BOT_TOKEN = os.environ.get('BOT_TOKEN') or 'token'
     MAIL_SERVER = 'smtp.googlemail.com'
@@ -3,13 +3,30 @@ Synchronize application's database with data from web service.
 """
 import os
 import re
+import sys
 import json
+import codecs
+import argparse
+import socket
+import hashlib
+import httplib
+import urlparse
+import Queue
+import itertools
+import threading
+import traceback
 import multiprocessing
 import time
 import datetime
 import logging
 
-from urllib2 import urlopen, HTTPError
+from collections import OrderedDict, Counter
+from decimal import Decimal
+from multiprocessing.pool import ThreadPool
+from urllib2 import urlopen
+
+from sqlalchemy import select, bindparam, and_
+from sqlalchemy.exc import IntegrityError
 
 from manage import app, db
 
@@ -17,255 +34,1423 @@ from manage import app, db
 FORMAT = ' %(levelname)s %(asctime)-15s PID:%(process)s - %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT, filename='sync.log')
 basedir = os.path.abspath(os.path.dirname(__file__))
+output_lock = threading.Lock()
 re_avatar_url = re.compile(r'(\/media\/foto_persone&#x2F;\w&#x2F;.*(.jpg|.png|.jpeg))', flags=re.I)
 
+FEEDS_URL = 'http://static.unive.it/sitows/didattica/'
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+POLL_INTERVAL = 5
+SUMMARY_LABELS = ('inserted', 'added', 'updated', 'moved', 'removed', 'deleted',
+                  'collapsed', 'unchanged')
+DATA_VERSIONS = {'lessons': ('calendars', 'courses', 'lessons'),
+                 'catalogue': ('avatars', 'classrooms', 'curriculums', 'degrees',
+                               'locations', 'professors')}
+
+LESSON_KEY = ('start', 'end', 'calendar_id', 'description')
+LESSON_DATE_FORMAT = '%Y-%m-%d%H:%M'
+SNAPSHOT_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+SNAPSHOT_FILE = os.path.join(basedir, 'lessons_snapshot.json')
+
+LEDGER_FILE = os.path.join(basedir, 'sync_ledger.json')
+
+AVATAR_PAGE_URL = 'http://www.unive.it/data/persone/%s'
+AVATAR_CACHE_DIR = os.path.join(basedir, 'avatar_cache')
+
+
+def batches(rows, size=BATCH_SIZE):
+    """Group the rows of an iterable into lists of at most `size` rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def differs(old, new):
+    """Compare a stored value with a feed value. Numeric columns may come
+    back from the database as floats or Decimals, so they are compared
+    with a small tolerance.
+
+    """
+    numbers = (int, long, float, Decimal)
+    if isinstance(old, numbers) and isinstance(new, numbers):
+        return abs(float(old) - float(new)) > 1e-6
+    return old != new
+
+
+def load_key_map(table, key, where=None):
+    """Return a dict mapping the natural key of every row of `table`
+    (optionally restricted by a `where` clause) to the row itself, as
+    a plain dict.
+
+    """
+    key = key if isinstance(key, tuple) else (key,)
+    query = select([table])
+    if where is not None:
+        query = query.where(where)
+    result = db.engine.execute(query)
+    return dict((tuple(r[k] for k in key), dict(r)) for r in result)
+
+
+def load_keys(table, key, keys, where=None):
+    """Return the key map of the rows of `table` whose natural `key` is
+    one of `keys`, read with one query per batch of keys. Composite keys
+    are only restricted by the `where` clause.
+
+    """
+    if len(key) > 1:
+        return load_key_map(table, key, where)
+    existing = {}
+    for batch in batches([k[0] for k in keys]):
+        condition = table.c[key[0]].in_(batch)
+        if where is not None:
+            condition = and_(condition, where)
+        existing.update(load_key_map(table, key, condition))
+    return existing
+
+
+def load_id_map(table, key, where=None):
+    """Return a dict mapping the natural key of every row of `table`
+    to its primary key.
+
+    """
+    return dict((k if len(k) > 1 else k[0], r['id'])
+                for k, r in load_key_map(table, key, where).iteritems())
+
+
+class IdCache(object):
+    """Maps from natural keys to primary keys, used to resolve foreign
+    keys during the sync.
+
+    Each map is loaded once per process and dropped when rows are
+    inserted in its table. Since other processes may insert rows too, a
+    lookup miss reloads the map, at most once per batch of the calling
+    thread. The maps are shared by the stages running in concurrent
+    threads, so they are guarded by a lock.
+
+    """
+    def __init__(self):
+        self.maps = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def new_batch(self):
+        self.local.reloaded = set()
+
+    def invalidate(self, table):
+        with self.lock:
+            for name, key in self.maps.keys():
+                if name == table.name:
+                    self.maps.pop((name, key), None)
+
+    def get(self, table, key):
+        """Return the whole map of `table` on `key`, loading it if needed."""
+        with self.lock:
+            ids = self.maps.get((table.name, key))
+        if ids is None:
+            ids = load_id_map(table, key)
+            with self.lock:
+                self.maps[(table.name, key)] = ids
+        return ids
+
+    def resolve(self, table, key, value):
+        """Return the primary key of the row of `table` whose `key` is
+        `value`, or None if there is none.
 
-def add_or_update(session, model, search_key=None, **kwargs):
-    """ Add a model object to the database. If such object exists
-    for a given search key then update it.
+        """
+        ids = self.get(table, key)
+        if not hasattr(self.local, 'reloaded'):
+            self.new_batch()
+        if value not in ids and (table.name, key) not in self.local.reloaded:
+            self.local.reloaded.add((table.name, key))
+            with self.lock:
+                self.maps.pop((table.name, key), None)
+            ids = self.get(table, key)
+        return ids.get(value)
+
+
+id_cache = IdCache()
+
+
+def bulk_upsert(table, rows, key, where=None, existing=None):
+    """Reconcile `rows` against `table` using the natural `key`.
+
+    The existing rows with the keys of `rows` (restricted by the optional
+    `where` clause) are loaded unless their key map is given as
+    `existing`, then missing rows are inserted and changed rows are
+    updated with batched executemany statements, one transaction per
+    batch. Returns a summary with the number of inserted, updated and
+    unchanged rows.
+
+    """
+    key = key if isinstance(key, tuple) else (key,)
+    unique = OrderedDict((tuple(row[c] for c in key), row) for row in rows)
+    if existing is None:
+        existing = load_keys(table, key, unique.keys(), where)
+    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    to_insert, to_update = [], []
+    for k, row in unique.iteritems():
+        current = existing.get(k)
+        if current is None:
+            to_insert.append(row)
+        elif any(differs(current[c], v) for c, v in row.iteritems()):
+            params = dict(('b_' + c, v) for c, v in row.iteritems())
+            params['b_id'] = current['id']
+            to_update.append(params)
+        else:
+            summary['unchanged'] += 1
+
+    for batch in batches(to_insert):
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), batch)
+        summary['inserted'] += len(batch)
+    if to_insert:
+        id_cache.invalidate(table)
+
+    if to_update:
+        columns = [c for c in rows[0].keys() if c not in key]
+        stmt = table.update() \
+            .where(table.c.id == bindparam('b_id')) \
+            .values(dict((c, bindparam('b_' + c)) for c in columns))
+        for batch in batches(to_update):
+            with db.engine.begin() as conn:
+                conn.execute(stmt, batch)
+            summary['updated'] += len(batch)
+
+    return summary
+
+
+def sync_pairs(table, pairs, owners=None):
+    """Make the rows of the association `table` match the set of
+    `pairs`, given in the order of the table's columns.
+
+    When `owners` is given only the rows whose first column is one of
+    them are reconciled, otherwise the whole table is. Existing pairs are
+    read with one query per batch of owners, then missing pairs are
+    inserted and stale ones deleted with executemany statements.
+    Duplicated rows are collapsed into one. Returns a summary with the
+    number of inserted, deleted, collapsed and unchanged pairs.
 
     """
-    params = {search_key: kwargs[search_key]} \
-        if search_key in kwargs.keys() else kwargs
-    instance = session.query(model).filter_by(**params).first()
-    if instance:
-        logging.info('Updating "%s"' % model.__name__)
-        for key, value in kwargs.iteritems():
-            setattr(instance, key, value)
-            session.merge(instance)
-    else:
-        logging.info('Adding "%s"' % model.__name__)
-        instance = model(**kwargs)
-        session.add(instance)
-    session.commit()
-    return instance
+    left, right = [c.name for c in table.columns]
+    queries = [select([table])]
+    if owners is not None:
+        queries = [select([table]).where(table.c[left].in_(batch))
+                   for batch in batches(sorted(set(owners)))]
+    existing = Counter()
+    for query in queries:
+        existing.update((r[left], r[right]) for r in db.engine.execute(query))
+
+    duplicated = set(p for p, n in existing.iteritems() if n > 1 and p in pairs)
+    to_delete = [p for p in existing if p not in pairs] + list(duplicated)
+    to_insert = [p for p in pairs if p not in existing] + list(duplicated)
+    stmt = table.delete().where(and_(table.c[left] == bindparam('b_left'),
+                                     table.c[right] == bindparam('b_right')))
+    for batch in batches(to_delete):
+        with db.engine.begin() as conn:
+            conn.execute(stmt, [dict(b_left=l, b_right=r) for l, r in batch])
+    for batch in batches(to_insert):
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), [{left: l, right: r} for l, r in batch])
+    return {'inserted': len(to_insert) - len(duplicated),
+            'deleted': len(to_delete) - len(duplicated),
+            'collapsed': len(duplicated),
+            'unchanged': len(pairs) - len(to_insert) + len(duplicated)}
+
+
+def dedup_pairs(table):
+    """Collapse the duplicated rows of the whole association `table`,
+    keeping every pair once.
+
+    """
+    return sync_pairs(table, set(tuple(r) for r in db.engine.execute(select([table]))))
+
+
+def dedup_associations():
+    """Collapse the duplicated rows of the association tables, which an
+    existing database must be cleared of before their unique constraints
+    are added.
+
+    """
+    from app.models import held_at, courses_curriculums, follows, reads
+
+    for table in (held_at, courses_curriculums, follows, reads):
+        report(table.name, dedup_pairs(table))
+
+
+def bump_data_versions(summaries):
+    """Bump the data versions built on the entities changed according to
+    a stage's `summaries`, invalidating the caches which depend on them.
+
+    """
+    from app.models import DataVersion
+
+    changed = set(entity for entity, summary in summaries.iteritems()
+                  if any(n for label, n in summary.iteritems() if label != 'unchanged'))
+    for name, entities in sorted(DATA_VERSIONS.iteritems()):
+        if changed.intersection(entities):
+            DataVersion.bump(name)
+    db.session.commit()
+
+
+def echo(msg):
+    """Print a line of output, without mixing it up with the lines
+    printed by concurrent stages.
+
+    """
+    with output_lock:
+        sys.stdout.write(msg + '\n')
+        sys.stdout.flush()
+
+
+def report(entity, summary):
+    counts = ['%s %s' % (summary[label], label) for label in SUMMARY_LABELS
+              if label in summary]
+    msg = '%s: %s' % (entity, ', '.join(counts))
+    logging.info(msg)
+    echo('  ' + msg)
 
 
 def merge_degrees(json_degrees):
     from app.models import Curriculum, Degree
 
-    for (i, row) in enumerate(json_degrees):
-        logging.info('Processing row %s of %s' % (i + 1, len(json_degrees)))
-        degree = add_or_update(
-            db.session, Degree, 'code',
-            code=row['CDS_COD'],
-            name=row['CDS_DES'],
-            category_code=row['TIPO_CORSO_COD'],
-            category_desc=row['TIPO_CORSO_DES']
-        )
-        add_or_update(
-            db.session, Curriculum,
-            code=row['PDS_COD'],
-            name=row['PDS_DES'],
-            degree=degree
-        )
-
-
-def get_professor_avatar_url(prof_id):
-    url = 'http://www.unive.it/data/persone/%s' % prof_id
-    try:
-        avatar = re_avatar_url.search(urlopen(url).read())
-    except HTTPError as e:
-        logging.warning('HTTP error')
-        return
+    degrees = [dict(code=row['CDS_COD'],
+                    name=row['CDS_DES'],
+                    category_code=row['TIPO_CORSO_COD'],
+                    category_desc=row['TIPO_CORSO_DES'])
+               for row in json_degrees]
+    summaries = {'degrees': bulk_upsert(Degree.__table__, degrees, 'code')}
+
+    curriculums = [dict(code=row['PDS_COD'],
+                        name=row['PDS_DES'],
+                        degree_id=id_cache.resolve(Degree.__table__, 'code', row['CDS_COD']))
+                   for row in json_degrees]
+    summaries['curriculums'] = bulk_upsert(
+        Curriculum.__table__, curriculums, ('code', 'degree_id'))
+    return summaries
+
+
+class RateLimiter(object):
+    """Space out the requests sent to each host by at least `interval`
+    seconds, across all the threads sharing the limiter.
+
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.slots = {}
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.slots.get(host, 0))
+            self.slots[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class AvatarFetcher(object):
+    """Resolve professors' avatar URLs by scraping their personal pages.
+
+    Pages are fetched by a pool of `n_threads` threads, each keeping a
+    persistent connection per host, with per-host rate limiting, timeouts
+    and retries. The outcome for each professor is cached on disk together
+    with the page's ETag and Last-Modified headers, so that later runs
+    only revalidate it with a conditional GET.
+
+    """
+    def __init__(self, url=AVATAR_PAGE_URL, cache_dir=AVATAR_CACHE_DIR,
+                 n_threads=8, interval=0.1, timeout=10, retries=3):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.n_threads = n_threads
+        self.limiter = RateLimiter(interval)
+        self.timeout = timeout
+        self.retries = retries
+        self.local = threading.local()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def connection(self, scheme, host):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        conn = self.local.connections.get((scheme, host))
+        if conn is None:
+            cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            conn = cls(host, timeout=self.timeout)
+            self.local.connections[(scheme, host)] = conn
+        return conn
+
+    def get(self, url, headers, redirects=3):
+        """Send a GET request and return the response status, headers and
+        body, following redirects and retrying on network errors.
+
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        for attempt in xrange(self.retries):
+            self.limiter.wait(parts.netloc)
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                logging.warning('Error fetching %s (attempt %s): %s' % (url, attempt + 1, e))
+                time.sleep(2 ** attempt * 0.5)
+                continue
+            if response.status in (301, 302, 303, 307) and redirects > 0:
+                location = urlparse.urljoin(url, response.getheader('location'))
+                return self.get(location, headers, redirects - 1)
+            if response.status >= 500:
+                logging.warning('HTTP %s fetching %s (attempt %s)' % (
+                    response.status, url, attempt + 1))
+                time.sleep(2 ** attempt * 0.5)
+                continue
+            return response.status, dict(response.getheaders()), body
+        return None, {}, None
+
+    def cache_path(self, prof_id):
+        return os.path.join(self.cache_dir, '%s.json' % prof_id)
+
+    def load_cached(self, prof_id):
+        try:
+            with open(self.cache_path(prof_id)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def store(self, prof_id, entry):
+        path = self.cache_path(prof_id)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.rename(path + '.tmp', path)
+
+    def fetch(self, prof_id):
+        """Return a (professor id, avatar URL) pair, where the URL is None
+        if the page has no picture, or None if the page couldn't be
+        fetched and nothing is cached.
+
+        """
+        cached = self.load_cached(prof_id)
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        status, response_headers, body = self.get(self.url % prof_id, headers)
+        if status == 304 and cached:
+            return prof_id, cached['avatar_url']
+        if status != 200:
+            logging.warning('Avatar of professor %s not fetched (HTTP %s)' % (prof_id, status))
+            return (prof_id, cached['avatar_url']) if cached else None
+        entry = {'etag': response_headers.get('etag'),
+                 'last_modified': response_headers.get('last-modified'),
+                 'avatar_url': avatar_url_from_page(body)}
+        self.store(prof_id, entry)
+        return prof_id, entry['avatar_url']
+
+    def fetch_all(self, prof_ids):
+        """Fetch the avatars of `prof_ids` concurrently and return a dict
+        mapping each resolved professor id to its avatar URL.
+
+        """
+        pool = ThreadPool(self.n_threads)
+        try:
+            results = pool.map(self.fetch, prof_ids)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(r for r in results if r is not None)
+
+
+def avatar_url_from_page(page):
+    avatar = re_avatar_url.search(page)
     return 'http://www.unive.it' + avatar.group(0).replace('&#x2F;', '/') if avatar else None
 
 
 def merge_professors(json_professors):
     from app.models import Professor
 
-    for (i, row) in enumerate(json_professors):
-        logging.info('Processing row %s of %s with id %s' % (
-            i + 1, len(json_professors), row['DOCENTE_ID']))
-        add_or_update(
-            db.session, Professor, 'id',
-            id=row['DOCENTE_ID'],
-            first_name=row['NOME'],
-            last_name=row['COGNOME'],
-            username=row['USERNAME'],
-            avatar_url=get_professor_avatar_url(row['DOCENTE_ID']),
-            email=row['MAIL'],
-        )
+    professors = [dict(id=row['DOCENTE_ID'],
+                       first_name=row['NOME'],
+                       last_name=row['COGNOME'],
+                       username=row['USERNAME'],
+                       email=row['MAIL'])
+                  for row in json_professors]
+    return {'professors': bulk_upsert(Professor.__table__, professors, 'id')}
+
+
+def stored_professors():
+    """Return the stored professors as rows of the docenti feed, for the
+    runs resumed after the professors stage.
+
+    """
+    from app.models import Professor
+
+    return [{'DOCENTE_ID': prof_id, 'MAIL': email}
+            for prof_id, email in db.session.query(Professor.id, Professor.email)]
+
+
+def merge_avatars(json_professors, fetcher=None):
+    """Resolve the avatar of every professor of the feed and store it,
+    falling back to a Gravatar hash when the page has no picture.
+
+    """
+    from app.models import Professor
+
+    fetcher = fetcher or AvatarFetcher()
+    emails = dict((row['DOCENTE_ID'], row['MAIL']) for row in json_professors)
+    avatars = fetcher.fetch_all(emails.keys())
+    rows = []
+    for prof_id, avatar_url in avatars.iteritems():
+        avatar_hash = None
+        if emails[prof_id] and not avatar_url:
+            avatar_hash = hashlib.md5(emails[prof_id].encode('utf-8')).hexdigest()
+        rows.append(dict(id=prof_id, avatar_url=avatar_url, avatar_hash=avatar_hash))
+    return {'avatars': bulk_upsert(Professor.__table__, rows, 'id')}
 
 
 def merge_courses(json_courses):
-    from app.models import Course, Calendar
-
-    for (i, row) in enumerate(json_courses):
-        logging.info('Processing row %s of %s' % (i + 1, len(json_courses)))
-        calendar = add_or_update(
-            db.session, Calendar, 'id',
-            id=row['AR_ID']
-        )
-
-        course = add_or_update(
-            db.session, Course, 'id',
-            id=row['AF_ID'],
-            name=row['NOME'],
-            code=row['CODICE'],
-            period=row['CICLO'],
-            credit=row['PESO'],
-            total_credit=row['PESO_TOTALE'],
-            year=row['ANNO_CORSO'],
-            partition=row['PARTIZIONE'],
-            field=row['SETTORE']
-        )
-
-        calendar.courses.append(course)
+    from app.models import Course, Calendar, rebuild_timetable
+
+    calendars = [dict(id=row['AR_ID']) for row in json_courses]
+    try:
+        summaries = {'calendars': bulk_upsert(Calendar.__table__, calendars, 'id')}
+    except IntegrityError:
+        # Courses are partitioned by course, so another process may have
+        # inserted the same calendar meanwhile.
+        summaries = {'calendars': bulk_upsert(Calendar.__table__, calendars, 'id')}
+
+    courses = [dict(id=row['AF_ID'],
+                    name=row['NOME'],
+                    code=row['CODICE'],
+                    period=row['CICLO'],
+                    credit=row['PESO'],
+                    total_credit=row['PESO_TOTALE'],
+                    year=row['ANNO_CORSO'],
+                    partition=row['PARTIZIONE'],
+                    field=row['SETTORE'],
+                    calendar_id=row['AR_ID'])
+               for row in json_courses]
+    existing = load_keys(Course.__table__, ('id',), [(c['id'],) for c in courses])
+    changed = [c['id'] for c in courses if (c['id'],) in existing and
+               any(differs(existing[(c['id'],)][f], c[f])
+                   for f in ('name', 'code', 'calendar_id'))]
+    summaries['courses'] = bulk_upsert(Course.__table__, courses, 'id', existing=existing)
+    if changed:
+        rebuild_timetable(course_ids=changed)
         db.session.commit()
+    return summaries
+
+
+def lesson_fingerprint(lesson):
+    """Return a content hash of the start, end, description, classrooms
+    and calendar of a lesson.
+
+    """
+    content = u'|'.join([lesson['start'].isoformat(),
+                         lesson['end'].isoformat(),
+                         lesson['description'] or u'',
+                         u','.join(sorted(lesson['classrooms'])),
+                         unicode(lesson['calendar_id'])])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def parse_lessons(json_lessons):
+    """Group the rows of the `lezioni` feed into lessons (one row per
+    classroom upstream) and index them by fingerprint.
+
+    """
+    from app.models import Classroom
+
+    lessons = OrderedDict()
+    for row in json_lessons:
+        if id_cache.resolve(Classroom.__table__, 'code', row['AULA_ID']) is None:
+            logging.warning('Classroom "%s" not found' % row['AULA_ID'])
+            continue
+        lesson = dict(
+            start=datetime.datetime.strptime(row['GIORNO'] + row['INIZIO'], LESSON_DATE_FORMAT),
+            end=datetime.datetime.strptime(row['GIORNO'] + row['FINE'], LESSON_DATE_FORMAT),
+            description=row['DOCENTI'],
+            calendar_id=row['AR_ID'])
+        k = tuple(lesson[c] for c in LESSON_KEY)
+        lessons.setdefault(k, dict(lesson, classrooms=set()))['classrooms'].add(row['AULA_ID'])
+    return OrderedDict((lesson_fingerprint(l), l) for l in lessons.itervalues())
+
+
+def snapshot_from_db():
+    """Build the lesson snapshot from the database, used on the first
+    run or when the snapshot file has been lost.
+
+    """
+    from app.models import Lesson, Classroom, held_at
+
+    lessons, classrooms = Lesson.__table__, Classroom.__table__
+    query = select([lessons, classrooms.c.code]).select_from(
+        lessons.join(held_at).join(classrooms))
+    grouped = {}
+    for r in db.engine.execute(query):
+        lesson = grouped.setdefault(r[lessons.c.id], dict(
+            start=r[lessons.c.start],
+            end=r[lessons.c.end],
+            description=r[lessons.c.description],
+            calendar_id=r[lessons.c.calendar_id],
+            classrooms=set()))
+        lesson['classrooms'].add(r[classrooms.c.code])
+    return dict((lesson_fingerprint(l), l) for l in grouped.itervalues())
+
+
+def load_snapshot():
+    if not os.path.exists(SNAPSHOT_FILE):
+        logging.info('Snapshot not found, building it from the database')
+        return snapshot_from_db()
+    with open(SNAPSHOT_FILE) as f:
+        snapshot = json.load(f)
+    for lesson in snapshot.itervalues():
+        for c in ('start', 'end'):
+            lesson[c] = datetime.datetime.strptime(lesson[c], SNAPSHOT_DATE_FORMAT)
+        lesson['classrooms'] = set(lesson['classrooms'])
+    return snapshot
+
 
+def save_snapshot(lessons):
+    snapshot = dict((fp, dict(l,
+                              start=l['start'].strftime(SNAPSHOT_DATE_FORMAT),
+                              end=l['end'].strftime(SNAPSHOT_DATE_FORMAT),
+                              classrooms=sorted(l['classrooms'])))
+                    for fp, l in lessons.iteritems())
+    tmp = SNAPSHOT_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.rename(tmp, SNAPSHOT_FILE)
 
-def merge_lessons(json_lessons):
-    from app.models import Lesson, Classroom
-
-    date_format = '%Y-%m-%d%H:%M'
-    for (i, row) in enumerate(json_lessons):
-        logging.info('Processing row %s of %s' % (i + 1, len(json_lessons)))
-        classroom = Classroom.query.filter_by(code=row['AULA_ID']).first()
-        if classroom:
-            start = datetime.datetime.strptime(row['GIORNO'] + row['INIZIO'], date_format)
-            end = datetime.datetime.strptime(row['GIORNO'] + row['FINE'], date_format)
-            lesson = add_or_update(
-                db.session, Lesson,
-                start=start,
-                end=end,
-                description=row['DOCENTI'],
-                calendar_id=row['AR_ID'],
-            )
-            lesson.classrooms.append(classroom)
-            db.session.add(lesson)
-            db.session.commit()
+
+def diff_lessons(old, new):
+    """Compare two fingerprint indexes of lessons.
+
+    Returns the added lessons, the moved ones as (old, new) pairs and the
+    removed ones. The feed has no lesson identifier, so a removed and an
+    added lesson of the same calendar, description and day are paired
+    as a single moved lesson.
+
+    """
+    identity = lambda l: (l['calendar_id'], l['description'], l['start'].date())
+    candidates = {}
+    for fp in set(old) - set(new):
+        candidates.setdefault(identity(old[fp]), []).append(old[fp])
+    added, moved = [], []
+    for fp in set(new) - set(old):
+        same = candidates.get(identity(new[fp]))
+        if same:
+            moved.append((same.pop(), new[fp]))
         else:
-            logging.warn('Classroom not found')
+            added.append(new[fp])
+    removed = [l for group in candidates.itervalues() for l in group]
+    return added, moved, removed
+
+
+def lesson_ids_for(lessons):
+    """Return a dict mapping the key of each of `lessons` to the id of
+    its row, reading only the calendars involved.
+
+    """
+    from app.models import Lesson
+
+    calendar_ids = set(l['calendar_id'] for l in lessons)
+    if not calendar_ids:
+        return {}
+    return load_id_map(Lesson.__table__, LESSON_KEY,
+                       Lesson.calendar_id.in_(calendar_ids))
+
+
+def write_held_at(lessons, classroom_ids):
+    """Make the classrooms linked to `lessons` match their feed."""
+    from app.models import held_at
+
+    lesson_ids = lesson_ids_for(lessons)
+    ids = [lesson_ids[tuple(l[c] for c in LESSON_KEY)] for l in lessons]
+    pairs = set((i, classroom_ids[code])
+                for i, l in zip(ids, lessons) for code in l['classrooms'])
+    return sync_pairs(held_at, pairs, owners=ids)
+
+
+def refresh_timetable(lessons):
+    """Recompute the timetable rows of the followers of `lessons`."""
+    from app.models import rebuild_timetable
+
+    lesson_ids = lesson_ids_for(lessons)
+    ids = set(lesson_ids[k] for k in (tuple(l[c] for c in LESSON_KEY) for l in lessons)
+              if k in lesson_ids)
+    for batch in batches(sorted(ids)):
+        rebuild_timetable(lesson_ids=batch)
+        db.session.commit()
+
+
+def apply_added_lessons(added, classroom_ids):
+    from app.models import Lesson
+
+    if not added:
+        return
+    rows = [dict((c, l[c]) for c in LESSON_KEY) for l in added]
+    calendar_ids = set(l['calendar_id'] for l in added)
+    bulk_upsert(Lesson.__table__, rows, LESSON_KEY,
+                Lesson.calendar_id.in_(calendar_ids))
+    write_held_at(added, classroom_ids)
+
+
+def apply_moved_lessons(moved, classroom_ids):
+    """Move lessons to their new schedule and classrooms, then notify
+    the followers of lessons whose time has changed.
+
+    A lesson whose new key is already taken by another lesson, or by an
+    earlier move, cannot be moved there: the new lesson is upserted and
+    the old one is returned to be removed.
+
+    """
+    from app.models import Lesson, on_lesson_change_event
+
+    if not moved:
+        return []
+    lesson_ids = lesson_ids_for([old for old, new in moved])
+    taken = lesson_ids_for([new for old, new in moved])
+    changes, params, kept, collided = set(), [], [], []
+    for old, new in moved:
+        lesson_id = lesson_ids.get(tuple(old[c] for c in LESSON_KEY))
+        if lesson_id is None:
+            logging.warning('Lesson to move not found, adding it')
+            apply_added_lessons([new], classroom_ids)
+            continue
+        key = tuple(new[c] for c in LESSON_KEY)
+        if taken.get(key, lesson_id) != lesson_id:
+            logging.warning('Lesson moved onto an existing one, removing it')
+            collided.append((old, new))
+            continue
+        taken[key] = lesson_id
+        kept.append(new)
+        rescheduled = (old['start'], old['end']) != (new['start'], new['end'])
+        if rescheduled:
+            changes.add(lesson_id)
+        params.append(dict(b_id=lesson_id, b_start=new['start'], b_end=new['end'],
+                           b_has_changed=rescheduled))
+    table = Lesson.__table__
+    stmt = table.update().where(table.c.id == bindparam('b_id')).values(
+        start=bindparam('b_start'), end=bindparam('b_end'),
+        has_changed=table.c.has_changed | bindparam('b_has_changed'))
+    for batch in batches(params):
+        with db.engine.begin() as conn:
+            conn.execute(stmt, batch)
+    write_held_at(kept, classroom_ids)
+    apply_added_lessons([new for old, new in collided], classroom_ids)
+
+    for batch in batches(sorted(changes)):
+        for lesson in Lesson.query.filter(Lesson.id.in_(batch)):
+            on_lesson_change_event(lesson)
+        db.session.commit()
+    return [old for old, new in collided]
+
+
+def apply_removed_lessons(removed):
+    """Delete the removed lessons and publish a single cancellation feed
+    per calendar for the upcoming ones. Returns the number of deleted
+    lessons.
+
+    """
+    from app.models import Lesson, Calendar, held_at, user_timetable, \
+        on_lessons_cancel_event
+
+    lesson_ids = lesson_ids_for(removed)
+    deleted = [l for l in removed if tuple(l[c] for c in LESSON_KEY) in lesson_ids]
+    ids = [lesson_ids[tuple(l[c] for c in LESSON_KEY)] for l in deleted]
+    table = Lesson.__table__
+    for batch in batches(ids):
+        with db.engine.begin() as conn:
+            conn.execute(user_timetable.delete().where(
+                user_timetable.c.lesson_id.in_(batch)))
+            conn.execute(held_at.delete().where(held_at.c.lesson_id.in_(batch)))
+            conn.execute(table.delete().where(table.c.id.in_(batch)))
+
+    now = datetime.datetime.utcnow()
+    cancelled = {}
+    for l in deleted:
+        if l['start'] > now:
+            cancelled.setdefault(l['calendar_id'], []).append((l['start'], l['end']))
+    for calendar_id, lessons in cancelled.iteritems():
+        calendar = Calendar.query.get(calendar_id)
+        if calendar:
+            on_lessons_cancel_event(calendar, sorted(lessons))
+    db.session.commit()
+    return len(ids)
+
+
+def bump_calendar_versions(calendar_ids):
+    """Bump the version of the calendars whose lessons have changed,
+    invalidating their cached ICS fragments.
+
+    """
+    from app.models import Calendar
+
+    table = Calendar.__table__
+    for batch in batches(sorted(calendar_ids)):
+        with db.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.id.in_(batch))
+                         .values(version=table.c.version + 1))
+
+
+def apply_lesson_changes(changes):
+    """Apply a batch of the lesson changes computed by merge_lessons."""
+    from app.models import Classroom
+
+    classroom_ids = id_cache.get(Classroom.__table__, 'code')
+    added = [c['lesson'] for c in changes if c['kind'] == 'added']
+    moved = [(c['old'], c['lesson']) for c in changes if c['kind'] == 'moved']
+    removed = [c['lesson'] for c in changes if c['kind'] == 'removed']
+    apply_added_lessons(added, classroom_ids)
+    collided = apply_moved_lessons(moved, classroom_ids)
+    refresh_timetable(added + [new for old, new in moved])
+    deleted = apply_removed_lessons(removed + collided)
+    bump_calendar_versions(set(c['calendar_id'] for c in changes))
+    return {'lessons': {'added': len(added), 'moved': len(moved) - len(collided),
+                        'removed': deleted}}
+
+
+def merge_lessons(json_lessons, pool):
+    """Diff the lessons feed against the snapshot of the last run, then
+    apply the changes through `pool`, partitioned by calendar. Lessons
+    missing from the feed are removed only within the feed's date window.
+
+    """
+    lessons = parse_lessons(json_lessons)
+    if not lessons:
+        logging.warning('Empty lessons feed, nothing to merge')
+        return {}
+    start = min(l['start'] for l in lessons.itervalues())
+    end = max(l['end'] for l in lessons.itervalues())
+    added, moved, removed = diff_lessons(load_snapshot(), lessons)
+    changes = [dict(kind='added', calendar_id=l['calendar_id'], lesson=l)
+               for l in added]
+    changes += [dict(kind='moved', calendar_id=new['calendar_id'], lesson=new, old=old)
+                for old, new in moved]
+    changes += [dict(kind='removed', calendar_id=l['calendar_id'], lesson=l)
+                for l in removed if l['start'] >= start and l['end'] <= end]
+    summary = pool.run([apply_lesson_changes], changes, 'calendar_id').get(
+        'lessons', {'added': 0, 'moved': 0, 'removed': 0})
+    save_snapshot(lessons)
+    summary['unchanged'] = len(lessons) - len(added) - len(moved)
+    return {'lessons': summary}
 
 
 def merge_classrooms(json_classrooms):
     from app.models import Classroom, Location
 
-    for (i, row) in enumerate(json_classrooms):
-        logging.info('Processing row %s of %s' % (i + 1, len(json_classrooms)))
-        location = Location.query.filter_by(code=row['SEDE_ID']).first()
-        if location:
-            classroom = add_or_update(
-                db.session, Classroom,
-                code=row['AULA_ID'],
-                name=row['NOME'],
-                capacity=row['POSTI']
-            )
-            location.classrooms.append(classroom)
-            db.session.commit()
-        else:
-            logging.warning('Location not found')
+    classrooms = []
+    for row in json_classrooms:
+        location_id = id_cache.resolve(Location.__table__, 'code', row['SEDE_ID'])
+        if location_id is None:
+            logging.warning('Location "%s" not found' % row['SEDE_ID'])
+            continue
+        classrooms.append(dict(code=row['AULA_ID'],
+                               name=row['NOME'],
+                               capacity=row['POSTI'],
+                               location_id=location_id))
+    return {'classrooms': bulk_upsert(Classroom.__table__, classrooms, 'code')}
 
 
 def merge_locations(json_locations):
     from app.models import Location
 
-    for (i, row) in enumerate(json_locations):
-        logging.info('Processing row %s of %s' % (i + 1, len(json_locations)))
+    locations = []
+    for row in json_locations:
         lng, lat, polyline = None, None, None
         if row['COORDINATE']:
             lng, lat, polyline = row['COORDINATE'].split(',')
-        add_or_update(
-            db.session, Location,
-            code=row['SEDE_ID'],
-            name=row['NOME'],
-            address=row['INDIRIZZO'],
-            lat=lat,
-            lng=lng,
-            polyline=polyline,
-        )
+        locations.append(dict(code=row['SEDE_ID'],
+                              name=row['NOME'],
+                              address=row['INDIRIZZO'],
+                              lat=float(lat) if lat else None,
+                              lng=float(lng) if lng else None,
+                              polyline=polyline))
+    return {'locations': bulk_upsert(Location.__table__, locations, 'code')}
 
 
 def courses_professors(json_relation):
     from app.models import Course, Professor
 
-    for (i, row) in enumerate(json_relation):
-        logging.info('Processing row %s of %s' % (i + 1, len(json_relation)))
-        course = Course.query.get(row['AF_ID'])
-        professor = Professor.query.get(row['DOCENTE_ID'])
-        if course and professor:
-            professor.courses.append(course)
-            db.session.commit()
+    rows = []
+    for row in json_relation:
+        course_id = id_cache.resolve(Course.__table__, 'id', row['AF_ID'])
+        professor_id = id_cache.resolve(Professor.__table__, 'id', row['DOCENTE_ID'])
+        if course_id and professor_id:
+            rows.append(dict(id=course_id, professor_id=professor_id))
         else:
-            logging.warning('Instance not found')
+            logging.warning('Course "%s" or professor "%s" not found' % (
+                row['AF_ID'], row['DOCENTE_ID']))
+    if rows:
+        course_ids = [r['id'] for r in rows]
+        return {'courses_professors': bulk_upsert(
+            Course.__table__, rows, 'id', Course.id.in_(course_ids))}
 
 
 def courses_curriculums(json_relation):
-    from app.models import Course, Curriculum, Degree
-
-    for (i, row) in enumerate(json_relation):
-        logging.info('Processing row %s of %s' % (i + 1, len(json_relation)))
-        course = Course.query.get(row['AF_ID'])
-        degree = Degree.query.filter_by(code=row['CDS_COD']).first()
-        curriculum = Curriculum.query.filter_by(
-            code=row['PDS_COD'], degree=degree).first()
-        if course and curriculum:
-            curriculum.courses.append(course)
-            db.session.commit()
+    """Reconcile the whole courses_curriculums table with the feed, which
+    is read entirely since a course's curriculums may be spread over it.
+
+    """
+    from app.models import Course, Curriculum, Degree, courses_curriculums
+
+    pairs = set()
+    for row in json_relation:
+        course_id = id_cache.resolve(Course.__table__, 'id', row['AF_ID'])
+        degree_id = id_cache.resolve(Degree.__table__, 'code', row['CDS_COD'])
+        curriculum_id = id_cache.resolve(
+            Curriculum.__table__, ('code', 'degree_id'), (row['PDS_COD'], degree_id))
+        if course_id and curriculum_id:
+            pairs.add((course_id, curriculum_id))
         else:
-            logging.warning('Instance not found')
+            logging.warning('Course "%s" or curriculum "%s" not found' % (
+                row['AF_ID'], row['PDS_COD']))
+    if not pairs:
+        logging.warning('Empty courses_curriculums feed, nothing to merge')
+        return {}
+    return {'courses_curriculums': sync_pairs(courses_curriculums, pairs)}
 
 
-def parallel(worker, data, n_process):
-    """Split data into evenly size slices and dispatch each one to
-    a different process.
+class SyncError(Exception):
+    pass
 
-    """
-    if n_process <= 1:
-        return worker(data)
 
-    step = len(data) / n_process
-    jobs = []
-    for i in xrange(0, len(data), step):
-        p = multiprocessing.Process(
-            target=worker, args=(data[i:i + step],))
-        jobs.append(p)
+def add_summaries(totals, summaries):
+    """Add the counts of `summaries` to `totals`, entity by entity."""
+    for entity, summary in summaries.iteritems():
+        total = totals.setdefault(entity, dict.fromkeys(summary, 0))
+        for label, n in summary.iteritems():
+            total[label] = total.get(label, 0) + n
+    return totals
 
-    for p in jobs:
-        p.start()
 
-    for p in jobs:
-        p.join()
+def print_timings(timings):
+    print('Stage timings:')
+    for name, elapsed in sorted(timings.iteritems(), key=lambda t: -t[1]):
+        print('  %-20s %8.2f secs' % (name, elapsed))
 
 
-if __name__ == '__main__':
-    n_process = 2
-    baseurl = 'http://static.unive.it/sitows/didattica/'
+def run_batch(workers, batch):
+    """Run `workers` on a batch, returning the batch's summaries and the
+    formatted traceback of the error that stopped it, if any.
+
+    """
     start = time.time()
+    summaries = {}
+    id_cache.new_batch()
+    try:
+        for worker in workers:
+            add_summaries(summaries, worker(batch) or {})
+    except Exception:
+        db.session.rollback()
+        logging.exception('Batch of %s rows failed' % len(batch))
+        return summaries, traceback.format_exc()
+    finally:
+        db.session.remove()
+    logging.info('Batch of %s rows merged in %.2f secs' % (len(batch), time.time() - start))
+    return summaries, None
+
 
+def worker_loop(tasks, results):
+    """Main loop of a pool process: merge the batches of the `tasks` queue
+    until a None sentinel is received.
+
+    """
     with app.app_context():
+        for run_id, workers, batch in iter(tasks.get, None):
+            results.put((run_id,) + run_batch(workers, batch))
+
+
+class SyncPool(object):
+    """Pool of processes merging feed rows.
+
+    Every process owns a task queue and opens its own database
+    connections, since the engine is disposed before forking. Rows are
+    routed to the processes by the hash of a partition key (e.g. the
+    calendar id), so the rows sharing a key are always merged by the same
+    process, one batch after the other, and two processes never write
+    the same rows. With a single process batches are merged inline.
 
-        print('# Merging locations')
-        json_locations = json.load(urlopen((baseurl + 'sedi')))
-        parallel(merge_locations, json_locations, n_process)
+    Several runs may share the pool from different threads: results are
+    tagged with their run id and handed back by a collector thread. The
+    queues are polled every POLL_INTERVAL seconds, raising SyncError if
+    a process has died.
 
-        print('# Merging classrooms')
-        json_classrooms = json.load(urlopen((baseurl + 'aule')))
-        parallel(merge_classrooms, json_classrooms, n_process)
+    """
+    def __init__(self, n_process, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.results = multiprocessing.Queue()
+        self.queues, self.processes = [], []
+        self.runs = {}
+        self.run_ids = itertools.count()
+        if n_process <= 1:
+            return
+        db.session.remove()
+        db.engine.dispose()
+        for i in xrange(n_process):
+            tasks = multiprocessing.Queue(maxsize=2)
+            p = multiprocessing.Process(target=worker_loop, args=(tasks, self.results))
+            p.daemon = True
+            p.start()
+            self.queues.append(tasks)
+            self.processes.append(p)
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def collect(self):
+        for result in iter(self.results.get, None):
+            self.runs[result[0]].put(result[1:])
+
+    def run(self, workers, rows, key, stats=None):
+        """Merge `rows` with `workers`, partitioning them on the `key`
+        field. Returns the accumulated summaries, or raises SyncError once
+        every batch is done if any of them failed. The number of merged
+        rows and batches is added to the optional `stats` dict.
+
+        """
+        run_id = next(self.run_ids)
+        results = self.runs[run_id] = Queue.Queue()
+        totals, errors, pending = {}, [], [0]
+        stats = stats if stats is not None else {}
+        stats.setdefault('rows', 0)
+        stats.setdefault('batches', 0)
+
+        def collect(summaries, error):
+            add_summaries(totals, summaries)
+            stats['batches'] += 1
+            if error:
+                errors.append(error)
+
+        def dispatch(i, batch):
+            if not self.queues:
+                return collect(*run_batch(workers, batch))
+            self.put(self.queues[i], (run_id, workers, batch))
+            pending[0] += 1
+            while not results.empty():
+                collect(*results.get())
+                pending[0] -= 1
+
+        try:
+            buffers = [[] for _ in xrange(max(len(self.queues), 1))]
+            for row in rows:
+                stats['rows'] += 1
+                i = hash(row[key]) % len(buffers)
+                buffers[i].append(row)
+                if len(buffers[i]) >= self.batch_size:
+                    dispatch(i, buffers[i])
+                    buffers[i] = []
+            for i, batch in enumerate(buffers):
+                if batch:
+                    dispatch(i, batch)
+        finally:
+            try:
+                while pending[0]:
+                    collect(*self.get(results))
+                    pending[0] -= 1
+            finally:
+                del self.runs[run_id]
+
+        if errors:
+            raise SyncError('%s batches failed, first error:\n%s' % (len(errors), errors[0]))
+        return totals
+
+    def check(self):
+        dead = [p.pid for p in self.processes if not p.is_alive()]
+        if dead:
+            raise SyncError('Pool processes %s died' % ', '.join(map(str, dead)))
+
+    def put(self, tasks, task):
+        while True:
+            try:
+                return tasks.put(task, timeout=POLL_INTERVAL)
+            except Queue.Full:
+                self.check()
+
+    def get(self, results):
+        while True:
+            try:
+                return results.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                self.check()
+
+    def close(self):
+        for tasks, p in zip(self.queues, self.processes):
+            if p.is_alive():
+                tasks.put(None)
+        for p in self.processes:
+            p.join()
+        if self.processes:
+            self.results.put(None)
+            self.collector.join()
+
+
+class Scheduler(object):
+    """Run the sync stages, each in its own thread, as soon as all the
+    stages they depend on are done.
+
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
 
-        print('# Merging professors')
-        json_professors = json.load(urlopen((baseurl + 'docenti')))
-        parallel(merge_professors, json_professors, n_process)
+    def add(self, name, func, requires=()):
+        unknown = set(requires) - set(self.stages)
+        if unknown:
+            raise ValueError('Unknown stages: %s' % ', '.join(sorted(unknown)))
+        self.stages[name] = (func, set(requires))
 
-        print('# Merging degrees and curriculums')
-        json_degrees = json.load(urlopen((baseurl + 'corsi')))
-        parallel(merge_degrees, json_degrees, n_process)
+    def execute(self, name, done):
+        start = time.time()
+        result, error = None, None
+        with app.app_context():
+            try:
+                result = self.stages[name][0]()
+            except Exception:
+                logging.exception('Stage "%s" failed' % name)
+                error = traceback.format_exc()
+            finally:
+                db.session.remove()
+        done.put((name, time.time() - start, result, error))
 
-        print('# Merging courses')
-        json_courses = json.load(urlopen((baseurl + 'insegnamenti')))
-        parallel(merge_courses, json_courses, n_process)
+    def run(self, skip=(), on_done=None):
+        """Run all the stages but the ones in `skip`, which are considered
+        already done, and return their durations. `on_done` is called with
+        the name, duration, result and error of every finished stage.
+        Once a stage fails no new stage is started, and SyncError is
+        raised when the running ones are over, with the durations of the
+        finished stages as its `timings` attribute.
 
-        print('# Merging lessons')
-        json_lessons = json.load(urlopen((baseurl + 'lezioni')))
-        parallel(merge_lessons, json_lessons, n_process)
+        """
+        pending = OrderedDict((name, set(requires) - set(skip))
+                              for name, (func, requires) in self.stages.iteritems()
+                              if name not in skip)
+        done, running, timings, errors = Queue.Queue(), set(), OrderedDict(), []
+        while pending or running:
+            ready = [name for name, requires in pending.iteritems() if not requires]
+            for name in ready if not errors else []:
+                del pending[name]
+                running.add(name)
+                echo('# Starting %s' % name)
+                threading.Thread(target=self.execute, args=(name, done)).start()
+            if not running:
+                break
+            name, elapsed, result, error = done.get()
+            running.remove(name)
+            timings[name] = elapsed
+            echo('# %s %s in %.2f secs' % (name, 'failed' if error else 'done', elapsed))
+            if on_done:
+                on_done(name, elapsed, result, error)
+            if error:
+                errors.append(error)
+            for requires in pending.itervalues():
+                requires.discard(name)
+        if errors:
+            error = SyncError('%s stages failed, first error:\n%s' % (len(errors), errors[0]))
+            error.timings = timings
+            raise error
+        return timings
+
+
+class Ledger(object):
+    """Persistent record of the sync runs.
+
+    For every run it keeps the status, the options and, for each stage,
+    its duration, the number of rows and batches merged, the rows per
+    second, the summaries and the error if it failed. Completed stages
+    are checkpoints: a resumed run skips them. Only the last `keep` runs
+    are kept.
+
+    """
+    def __init__(self, path=LEDGER_FILE, keep=100):
+        self.path = path
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.runs = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self.runs = json.load(f)
+        self.run = None
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.runs[-self.keep:], f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+    def start(self, options, resume=False):
+        """Open a new run, or reopen the last one if `resume` is set and it
+        didn't complete. Returns the names of the stages already done.
+
+        """
+        with self.lock:
+            if resume and self.runs and self.runs[-1]['status'] != 'done':
+                self.run = self.runs[-1]
+                self.run['resumed'] = self.run.get('resumed', 0) + 1
+            else:
+                self.run = {'started': datetime.datetime.utcnow().isoformat(),
+                            'options': options,
+                            'stages': {}}
+                self.runs.append(self.run)
+            self.run['status'] = 'running'
+            self.save()
+            return set(name for name, stage in self.run['stages'].iteritems()
+                       if stage['status'] == 'done')
+
+    def record(self, name, elapsed, result, error):
+        result = result or {}
+        rows = result.get('rows', 0)
+        with self.lock:
+            self.run['stages'][name] = {
+                'status': 'failed' if error else 'done',
+                'finished': datetime.datetime.utcnow().isoformat(),
+                'duration': round(elapsed, 3),
+                'rows': rows,
+                'batches': result.get('batches'),
+                'rows_per_sec': round(rows / elapsed, 1) if elapsed else None,
+                'summaries': result.get('summaries'),
+                'error': error}
+            self.save()
+
+    def finish(self, status):
+        with self.lock:
+            self.run['status'] = status
+            self.run['finished'] = datetime.datetime.utcnow().isoformat()
+            self.save()
+
+    def history(self, n):
+        """Print the duration of each stage in the last `n` runs."""
+        runs = self.runs[-n:]
+        names = sorted(set(name for run in runs for name in run['stages']))
+        echo('%-20s' % 'stage' + ''.join('%12s' % run['started'][5:16].replace('T', ' ')
+                                         for run in runs))
+        for name in names:
+            cells = []
+            for run in runs:
+                stage = run['stages'].get(name)
+                if stage is None:
+                    cells.append('%12s' % '-')
+                elif stage['status'] == 'failed':
+                    cells.append('%12s' % 'failed')
+                else:
+                    cells.append('%12.2f' % stage['duration'])
+            echo('%-20s' % name + ''.join(cells))
+        echo('%-20s' % 'status' + ''.join('%12s' % run['status'] for run in runs))
+
+
+def iter_json_array(stream, chunk_size=CHUNK_SIZE):
+    """Incrementally parse a JSON array read from a file-like `stream`,
+    yielding its elements one at a time without loading the whole
+    document in memory.
+
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof, started = u'', 0, False, False
+    while True:
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+        if not started and pos < len(buf):
+            if buf[pos] != u'[':
+                raise ValueError('Feed is not a JSON array')
+            started = True
+            pos += 1
+            continue
+        if pos < len(buf) and buf[pos] == u']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            item, end = None, None
+        # An element ending right at the end of the buffer may be a
+        # truncated number, so it's accepted only once the stream is over.
+        if end is not None and (end < len(buf) or eof):
+            yield item
+            pos = end
+            continue
+        if eof:
+            raise ValueError('Truncated JSON array')
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + utf8.decode(chunk, final=eof)
+        pos = 0
 
-        print('# Merging courses_curriculums')
-        json_relation = json.load(urlopen((baseurl + 'corsiinsegnamenti')))
-        parallel(courses_curriculums, json_relation, n_process)
 
-        print('# Merging courses_professors')
-        json_relation = json.load(urlopen((baseurl + 'insegnamentidocenti')))
-        parallel(courses_professors, json_relation, n_process)
+class TeeStream(object):
+    """File-like wrapper copying everything read from `stream` to `copy`."""
+
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.copy.write(chunk)
+        return chunk
+
+    def close(self):
+        self.stream.close()
+        self.copy.close()
+
+
+def open_feed(name, feeds_dir=None, dump_dir=None):
+    """Open the `name` feed from the web service, or from the dump saved
+    in `feeds_dir` by a previous run. When `dump_dir` is given, the
+    downloaded feed is also saved there while it is read.
+
+    """
+    if feeds_dir:
+        return open(os.path.join(feeds_dir, name + '.json'), 'rb')
+    stream = urlopen(FEEDS_URL + name)
+    if dump_dir:
+        return TeeStream(stream, open(os.path.join(dump_dir, name + '.json'), 'wb'))
+    return stream
+
+
+def counted(rows, stats):
+    """Pass the rows of an iterable through, counting them in `stats`."""
+    for row in rows:
+        stats['rows'] += 1
+        yield row
+
+
+def kept(rows, into):
+    """Pass the rows of an iterable through, appending them to `into`."""
+    for row in rows:
+        into.append(row)
+        yield row
+
+
+def sync_feed(stream, workers, pool, key, keep=None):
+    """Stream the rows of a feed into `workers` through `pool`,
+    partitioned on the `key` field, and report the summaries. The rows
+    are also appended to the optional `keep` list. Returns the stage's
+    metrics.
+
+    """
+    stats = {}
+    rows = iter_json_array(stream)
+    if keep is not None:
+        rows = kept(rows, keep)
+    try:
+        totals = pool.run(workers, rows, key, stats)
+    finally:
+        stream.close()
+    for entity, summary in sorted(totals.iteritems()):
+        report(entity, summary)
+    return dict(stats, summaries=totals)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--feeds-dir',
+                        help='read the feeds dumped in this directory instead '
+                             'of downloading them')
+    parser.add_argument('--dump-dir',
+                        help='save the downloaded feeds in this directory')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--resume', action='store_true',
+                        help='resume the last run if it did not complete, '
+                             'skipping the stages it already completed')
+    parser.add_argument('--ledger', default=LEDGER_FILE,
+                        help='file recording the runs and their stages')
+    parser.add_argument('--history', type=int, metavar='N',
+                        help='show the stage durations of the last N runs and exit')
+    parser.add_argument('--dedup', action='store_true',
+                        help='collapse the duplicated rows of the association tables and exit')
+    args = parser.parse_args()
+    ledger = Ledger(args.ledger)
+    if args.history:
+        ledger.history(args.history)
+        sys.exit()
+    if args.dedup:
+        with app.app_context():
+            dedup_associations()
+        sys.exit()
+    if args.dump_dir and not os.path.isdir(args.dump_dir):
+        os.makedirs(args.dump_dir)
+
+    def feed(name):
+        return open_feed(name, args.feeds_dir, args.dump_dir)
+
+    def stage(name, workers, key, keep=None):
+        return lambda: sync_feed(feed(name), workers, pool, key, keep)
+
+    def whole(name, merge):
+        def run():
+            stats = {'rows': 0}
+            stream = feed(name)
+            try:
+                summaries = merge(counted(iter_json_array(stream), stats))
+            finally:
+                stream.close()
+            for entity, summary in sorted(summaries.iteritems()):
+                report(entity, summary)
+            return dict(stats, summaries=summaries)
+        return run
+
+    def avatars():
+        rows = professor_rows or stored_professors()
+        summaries = merge_avatars(rows, fetcher)
+        for entity, summary in sorted(summaries.iteritems()):
+            report(entity, summary)
+        return {'rows': len(rows), 'summaries': summaries}
+
+    start = time.time()
+    professor_rows = []
+
+    with app.app_context():
+        from app.models import DataVersion
+
+        DataVersion.seed(*DATA_VERSIONS)
+        if db.engine.name == 'sqlite' and args.processes > 1:
+            echo('# SQLite allows a single writer, merging in one process')
+            args.processes = 1
+        pool = SyncPool(args.processes, args.batch_size)
+        fetcher = AvatarFetcher()
+        scheduler = Scheduler()
+        scheduler.add('locations', stage('sedi', [merge_locations], 'SEDE_ID'))
+        scheduler.add('classrooms', stage('aule', [merge_classrooms], 'AULA_ID'),
+                      requires=['locations'])
+        scheduler.add('professors', stage('docenti', [merge_professors], 'DOCENTE_ID',
+                                          keep=professor_rows))
+        scheduler.add('avatars', avatars, requires=['professors'])
+        scheduler.add('degrees', stage('corsi', [merge_degrees], 'CDS_COD'))
+        scheduler.add('courses', stage('insegnamenti', [merge_courses], 'AF_ID'))
+        scheduler.add('lessons', whole('lezioni', lambda rows: merge_lessons(rows, pool)),
+                      requires=['classrooms', 'courses'])
+        scheduler.add('courses_curriculums', whole('corsiinsegnamenti', courses_curriculums),
+                      requires=['courses', 'degrees'])
+        scheduler.add('courses_professors',
+                      stage('insegnamentidocenti', [courses_professors], 'AF_ID'),
+                      requires=['courses', 'professors'])
+        done = ledger.start(vars(args), args.resume)
+        if done:
+            echo('# Resuming, skipping %s' % ', '.join(sorted(done)))
+        def on_done(name, elapsed, result, error):
+            ledger.record(name, elapsed, result, error)
+            if not error:
+                bump_data_versions(result.get('summaries') or {})
+
+        try:
+            timings = scheduler.run(skip=done, on_done=on_done)
+        except BaseException as e:
+            ledger.finish('failed')
+            if getattr(e, 'timings', None):
+                print_timings(e.timings)
+            raise
+        else:
+            ledger.finish('done')
+        finally:
+            pool.close()
 
+    print_timings(timings)
     print('Done in %s secs (~%s min)' % (time.time() - start, (time.time() - start) / 60))
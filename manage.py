@@ -97,6 +97,20 @@ def insertfeed(professor_id):
     db.session.commit()
 
 
+@manager.command
+def rebuildtimetable():
+    """Recompute the timetable of every user, setting the timetable
+    update time of the users which have none.
+
+    """
+    table = models.User.__table__
+    db.session.execute(table.update()
+                       .where(table.c.timetable_updated == None)
+                       .values(timetable_updated=table.c.member_since))
+    models.rebuild_timetable()
+    db.session.commit()
+
+
 @manager.command
 def delaylesson(lesson_id, hours=1):
     from datetime import timedelta
@@ -107,6 +121,23 @@ def delaylesson(lesson_id, hours=1):
     db.session.commit()
 
 
+@manager.command
+def explainlessons(calendar_id, start, end, repeat=100):
+    """Print the query plan and timing of a calendar's lessons window."""
+    import time
+
+    query = models.Calendar.query.get(calendar_id).lessons_between(start, end)
+    sql = str(query.statement.compile(dialect=db.engine.dialect,
+                                      compile_kwargs={'literal_binds': True}))
+    explain = 'EXPLAIN QUERY PLAN ' if db.engine.name == 'sqlite' else 'EXPLAIN ANALYZE '
+    for row in db.session.execute(explain + sql):
+        print ' '.join(str(c) for c in row)
+    start_time = time.time()
+    for _ in xrange(int(repeat)):
+        db.session.execute(sql).fetchall()
+    print '%.3f ms per query' % ((time.time() - start_time) * 1000 / int(repeat))
+
+
 @manager.command
 def addusers():
     u = models.User(email='bob@unive.it',
@@ -165,5 +196,14 @@ def trinit():
     os.unlink('messages.pot')
 
 
+@manager.command
+def test():
+    """Run the unit tests."""
+    import unittest
+
+    tests = unittest.TestLoader().discover('tests')
+    unittest.TextTestRunner(verbosity=2).run(tests)
+
+
 if __name__ == '__main__':
     manager.run()
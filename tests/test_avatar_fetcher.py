@@ -0,0 +1,110 @@
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+from db_web_sync import AvatarFetcher
+
+
+PAGE = '<img src="/media/foto_persone&#x2F;r&#x2F;rossi.jpg">'
+AVATAR_URL = 'http://www.unive.it/media/foto_persone/r/rossi.jpg'
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the personal pages of the professors: /flaky answers 503
+    once, every page has an ETag and answers 304 when it matches.
+
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, dict(self.headers), time.time()))
+            failures = self.server.failures.get(self.path, 0)
+            if failures:
+                self.server.failures[self.path] = failures - 1
+        if failures:
+            self.reply(503, '')
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.reply(304, None)
+        else:
+            self.reply(200, PAGE)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('ETag', '"v1"')
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.failures = {}
+
+
+class AvatarFetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/%%s' % self.server.server_address[1]
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def fetcher(self, **kwargs):
+        kwargs.setdefault('interval', 0)
+        return AvatarFetcher(self.url, self.cache_dir, **kwargs)
+
+    def test_reuses_connection(self):
+        avatars = self.fetcher(n_threads=1).fetch_all(range(5))
+        self.assertEqual(avatars, dict((i, AVATAR_URL) for i in range(5)))
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_retries_on_server_error(self):
+        self.server.failures['/flaky'] = 1
+        self.assertEqual(self.fetcher().fetch('flaky'), ('flaky', AVATAR_URL))
+        self.assertEqual([r[0] for r in self.server.requests], ['/flaky', '/flaky'])
+
+    def test_revalidates_cached_avatar(self):
+        self.assertEqual(self.fetcher().fetch(1), (1, AVATAR_URL))
+        self.assertEqual(self.fetcher().fetch(1), (1, AVATAR_URL))
+        first, second = [r[1] for r in self.server.requests]
+        self.assertNotIn('if-none-match', first)
+        self.assertEqual(second['if-none-match'], '"v1"')
+
+    def test_rate_limits_requests(self):
+        self.fetcher(n_threads=4, interval=0.1).fetch_all(range(4))
+        times = sorted(r[2] for r in self.server.requests)
+        self.assertEqual(len(times), 4)
+        for previous, current in zip(times, times[1:]):
+            self.assertGreaterEqual(current - previous, 0.09)
+
+
+if __name__ == '__main__':
+    unittest.main()